@@ -0,0 +1,182 @@
+###########################################
+# Drift analytics over the TVC calibration history
+# - incremental ingest of log/LOG_intst.csv, log/LOG_indxCurr.csv into columnar arrays (cached in log/)
+# - per tube drift rate of intensity (relative to the session target) and of DAC index
+# - predicted date when each tube leaves the +/- limitVariation band --> is a full CAL run needed?
+###########################################
+import os
+import numpy as np
+from datetime import date
+from main import GEOMETRY_DEFAULT
+
+
+class LogSeries():
+    """columnar time series of one TVC log (date, n_iter, value per tube), read incrementally"""
+    def __init__(self, file_path, Ntube):
+        self.file_path = file_path
+        self.path_cache = os.path.splitext(file_path)[0] + '_cache.npz'
+        self.Ntube = Ntube
+        self.reset()
+        self._loadCache()
+
+    def reset(self):
+        self.offset = 0         # bytes of the log which were already ingested
+        self.n = 0              # number of rows
+        self._date = np.zeros(0, dtype='datetime64[D]')
+        self._n_iter = np.zeros(0, dtype=int)
+        self._values = np.zeros((0, self.Ntube), dtype=float)
+
+    @property
+    def date(self): return self._date[:self.n]
+
+    @property
+    def n_iter(self): return self._n_iter[:self.n]
+
+    @property
+    def values(self): return self._values[:self.n]
+
+    def _append(self, list_date, list_n_iter, list_values):
+        n_new = self.n + len(list_date)
+        if n_new > len(self._date):     # grow capacity x2
+            capacity = max(n_new, 2*len(self._date), 64)
+            self._date = np.resize(self._date, capacity)
+            self._n_iter = np.resize(self._n_iter, capacity)
+            self._values = np.resize(self._values, (capacity, self.Ntube))
+        self._date[self.n:n_new] = np.asarray(list_date, dtype='datetime64[D]')
+        self._n_iter[self.n:n_new] = list_n_iter
+        self._values[self.n:n_new] = list_values
+        self.n = n_new
+
+    def update(self):
+        """ingest the rows appended to the log since the last update, return # of new rows"""
+        if not os.path.exists(self.file_path): return 0
+        if os.path.getsize(self.file_path) < self.offset: self.reset()     # log was replaced
+        with open(self.file_path, 'rb') as fd:
+            fd.seek(self.offset)
+            content = fd.read()
+        end = content.rfind(b'\n') + 1      # ingest complete lines only
+        list_date, list_n_iter, list_values = [], [], []
+        for line in content[:end].decode().splitlines():
+            row = line.strip().split(',')
+            if len(row) != self.Ntube + 2: continue
+            list_date.append(row[0])
+            list_n_iter.append(int(row[1]))
+            list_values.append([float(v) for v in row[2:]])
+        self.offset += end
+        if list_date: self._append(list_date, list_n_iter, list_values)
+        self._saveCache()
+        return len(list_date)
+
+    def _saveCache(self):
+        np.savez(self.path_cache, offset=self.offset, date=self.date, n_iter=self.n_iter, values=self.values)
+
+    def _loadCache(self):
+        if not os.path.exists(self.path_cache): return
+        cache = np.load(self.path_cache)
+        if cache['values'].shape[1:] != (self.Ntube,): return
+        self._append(cache['date'], cache['n_iter'], cache['values'])
+        self.offset = int(cache['offset'])
+
+
+class DriftAnalysis():
+    def __init__(self, directory, limitVariation=0.03, Ntube=GEOMETRY_DEFAULT['Ntube']):
+        """directory: CAL directory (the path given to TVC.setPathCALdirectory())"""
+        self.limitVariation = limitVariation
+        self.Ntube = Ntube
+        self.log_intst = LogSeries(os.path.join(directory, 'log', 'LOG_intst.csv'), Ntube)
+        self.log_indxCurr = LogSeries(os.path.join(directory, 'log', 'LOG_indxCurr.csv'), Ntube)
+
+    def update(self):
+        n_intst, n_indx = self.log_intst.update(), self.log_indxCurr.update()
+        print("--- new rows: LOG_intst {n0}, LOG_indxCurr {n1}".format(n0=n_intst, n1=n_indx))
+
+    def getSessionDeviation(self):
+        """
+        relative deviation from the session target (trimmed mean of the first iteration, as _calculateNewTarget)
+        a session starts at n_iter == 0 in LOG_intst.csv
+        tubes which failed QC are logged as nan: first / last valid intensity of the session (nan if none)
+        :return: date of session, deviation at the first and at the last iteration (n_session x Ntube)
+        """
+        values, n_iter = self.log_intst.values, self.log_intst.n_iter
+        i_start = np.flatnonzero(n_iter == 0)
+        if len(i_start) == 0: return np.zeros(0, dtype='datetime64[D]'), np.zeros((0, self.Ntube)), np.zeros((0, self.Ntube))
+        i_end = np.append(i_start[1:], len(values))
+        dev_start, dev_end = np.full((len(i_start), self.Ntube), np.nan), np.full((len(i_start), self.Ntube), np.nan)
+        for k, (i0, i1) in enumerate(zip(i_start, i_end)):
+            first = values[i0]
+            target = np.sort(first[np.isfinite(first)])[1:-1].mean() if np.isfinite(first).sum() > 2 else np.nan
+            for iTube in range(self.Ntube):
+                valid = np.flatnonzero(np.isfinite(values[i0:i1, iTube]))
+                if len(valid) == 0: continue
+                dev_start[k, iTube] = values[i0 + valid[0], iTube]/target - 1
+                dev_end[k, iTube] = values[i0 + valid[-1], iTube]/target - 1
+        return self.log_intst.date[i_start], dev_start, dev_end
+
+    def getIntensityDrift(self):
+        """
+        drift rate of the relative intensity [1/day] per tube
+        drift between sessions: deviation at the start of a session - deviation at the end of the previous session
+        """
+        dates, dev_start, dev_end = self.getSessionDeviation()
+        days = np.diff(dates).astype(float)
+        valid = days > 0
+        if not valid.any(): return np.zeros(self.Ntube)
+        drift = (dev_start[1:] - dev_end[:-1])[valid]
+        ok = np.isfinite(drift)     # nan: no valid intensity (QC) in one of the sessions
+        days_ok = (ok*days[valid][:, None]).sum(axis=0)
+        return np.where(days_ok > 0, np.where(ok, drift, 0).sum(axis=0)/np.maximum(days_ok, 1), 0.0)
+
+    def getDACDrift(self):
+        """drift rate of the DAC index [1/day] per tube: least squares over the last DAC index of each day"""
+        dates, values = self.log_indxCurr.date, self.log_indxCurr.values
+        if len(dates) == 0: return np.zeros(self.Ntube)
+        i_last = np.append(np.flatnonzero(dates[1:] != dates[:-1]), len(dates) - 1)
+        x = (dates[i_last] - dates[i_last[0]]).astype(float)
+        if np.ptp(x) == 0: return np.zeros(self.Ntube)
+        y = values[i_last]
+        x = x - x.mean()
+        return (x[:, None]*(y - y.mean(axis=0))).sum(axis=0)/(x**2).sum()
+
+    def predictExit(self):
+        """
+        predicted date per tube when the intensity leaves +/- limitVariation (NaT: no drift)
+        starting from the deviation at the end of the last session
+        """
+        dates, dev_start, dev_end = self.getSessionDeviation()
+        arr_exit = np.full(self.Ntube, np.datetime64('NaT'), dtype='datetime64[D]')
+        if len(dates) == 0: return arr_exit
+        rate = self.getIntensityDrift()
+        dev = dev_end[-1]
+        margin = np.where(rate > 0, self.limitVariation - dev, self.limitVariation + dev)
+        drifting = (rate != 0) & np.isfinite(dev)
+        days = np.maximum(margin[drifting]/np.abs(rate[drifting]), 0)
+        arr_exit[drifting] = dates[-1] + np.floor(days).astype('timedelta64[D]')
+        return arr_exit
+
+    def isCALneeded(self, today=None, margin_days=0):
+        """
+        daily check: True if any tube is predicted to be out of the band by today + margin_days
+        :return: True/False, list of tube indices
+        """
+        today = np.datetime64(today or date.today(), 'D')
+        arr_exit = self.predictExit()
+        dates = self.getSessionDeviation()[0]
+        if len(dates) == 0: return True, list(range(self.Ntube))    # no calibration yet
+        out = ~np.isnat(arr_exit) & (arr_exit <= today + np.timedelta64(margin_days, 'D'))
+        return bool(out.any()), np.flatnonzero(out).tolist()
+
+    def report(self):
+        dates = self.getSessionDeviation()[0]
+        print("# of sessions: ", len(dates), " last CAL: ", dates[-1] if len(dates) else None)
+        print("intensity drift [%/day]: ", np.round(100*self.getIntensityDrift(), 4))
+        print("DAC index drift [1/day]: ", np.round(self.getDACDrift(), 3))
+        print("predicted date out of +/-{lim}%: ".format(lim=100*self.limitVariation), self.predictExit())
+        need, list_tube = self.isCALneeded()
+        print("!!! CAL needed !!! tubes: " if need else "CAL not needed", list_tube)
+
+
+if __name__ == "__main__":
+
+    drift = DriftAnalysis('D:/Data/Calibration_tube', limitVariation=0.03)
+    drift.update()
+    drift.report()
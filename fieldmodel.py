@@ -0,0 +1,124 @@
+###########################################
+# Smooth 2D field model over the step x tube ROI intensities (intensities of TVC.checkUniformity())
+# - 'poly'      : low-order 2D polynomial in (step position x, tube position y)
+# - 'separable' : step profile x smooth tube profile (polynomial in y), fitted on log(intensity)
+# one batched least-squares solve for one or many datasets of the same shape
+# --> correction map (field / mean), residual statistics, per tube target factor for TVC.setTargetFactor()
+###########################################
+import numpy as np
+from main import TVC
+
+
+class FieldModel():
+    def __init__(self, tvc=None, model='poly', degree=2):
+        """
+        tvc: TVC with the geometry of the datasets (tube centers, step size, pixel size)
+        degree: of the polynomial in (x, y) ('poly') or in y ('separable'), < Ntube - 1 so that the tube-to-tube
+        variation is not part of the field (it is what TVC corrects)
+        """
+        if model not in ('poly', 'separable'): raise Exception("E30: unknown field model: {m}".format(m=model))
+        self.tvc = tvc if tvc is not None else TVC()
+        if degree >= self.tvc.CONST_Ntube - 1:
+            raise Exception("E32: degree {d} >= Ntube - 1 fits the tube-to-tube variation".format(d=degree))
+        self.model = model
+        self.degree = degree
+        self.powers = [(i, j) for i in range(degree + 1) for j in range(degree + 1 - i)]    # x^i y^j, i+j <= degree
+
+    def _coordinates(self, nStep):
+        """step position x, tube position y [mm] and their scale to [-1, 1]"""
+        tvc = self.tvc
+        x = np.arange(nStep)*tvc.CONST_SizeStep
+        y = (np.asarray(tvc.r_tubes) - tvc.CONST_Npixel_y/2)*tvc.CONST_SizePixel
+        self.x_scale = max(np.abs(x - x.mean()).max(), 1.0), x.mean()
+        self.y_scale = max(np.abs(y).max(), 1.0)
+        return x, y
+
+    def _designPoly(self, x, y):
+        """design matrix of the polynomial at points (x, y) -- 1D arrays of the same size"""
+        u = (x - self.x_scale[1])/self.x_scale[0]
+        v = y/self.y_scale
+        return np.stack([u**i * v**j for i, j in self.powers], axis=1)
+
+    def _designSeparable(self, nStep, y):
+        """log I[s, t] = a_s + sum_j c_j v_t^j (j = 1 ... degree, v: tube position scaled to [-1, 1])"""
+        nTube = len(y)
+        rows = np.arange(nStep*nTube)
+        A = np.zeros((nStep*nTube, nStep + self.degree))
+        A[rows, rows // nTube] = 1
+        A[:, nStep:] = self._tubeProfile(y)[rows % nTube]
+        return A
+
+    def _tubeProfile(self, y):
+        """v^j (j = 1 ... degree) per tube position"""
+        v = np.asarray(y, dtype=float)/self.y_scale
+        return v[:, None]**np.arange(1, self.degree + 1)[None, :]
+
+    def fit(self, data):
+        """
+        data: step x tube intensity matrix (columns in tube index order, as TVC.checkUniformity()), or a stack of them (dataset x step x tube)
+        pixels <= 0 or NaN in any dataset are excluded
+        :return: self (coef, fieldMap, correctionMap, residual, stats)
+        """
+        data = np.asarray(data, dtype=float)
+        self.single = data.ndim == 2
+        if self.single: data = data[None]
+        nSet, nStep, nTube = data.shape
+        if nTube != self.tvc.CONST_Ntube:
+            raise Exception("E31: {n} tubes in data, {N} tubes in geometry".format(n=nTube, N=self.tvc.CONST_Ntube))
+        x, y = self._coordinates(nStep)
+        xx, yy = np.meshgrid(x, y, indexing='ij')
+        B = data.reshape(nSet, -1).T                                    # points x datasets
+        valid = np.all(np.isfinite(B) & (B > 0), axis=1)
+
+        if self.model == 'poly':
+            A = self._designPoly(xx.ravel(), yy.ravel())
+            self.coef = np.linalg.lstsq(A[valid], B[valid], rcond=None)[0]
+            fit = A @ self.coef
+        else:
+            A = self._designSeparable(nStep, y)
+            self.coef = np.linalg.lstsq(A[valid], np.log(B[valid]), rcond=None)[0]
+            fit = np.exp(A @ self.coef)
+
+        self.fieldMap = fit.T.reshape(nSet, nStep, nTube)
+        self.correctionMap = self.fieldMap/self.fieldMap.mean(axis=(1, 2), keepdims=True)   # field / mean
+        residual = np.where(valid[:, None], B/fit - 1, np.nan).T.reshape(nSet, nStep, nTube)
+        self.residual = residual
+        self.stats = {'rms': np.sqrt(np.nanmean(residual**2, axis=(1, 2))),
+                      'maxAbs': np.nanmax(np.abs(residual), axis=(1, 2)),
+                      'tube': np.nanmean(residual, axis=1),            # tube-to-tube variation on top of the field
+                      'step': np.nanmean(residual, axis=2),
+                      'nPoint': int(valid.sum())}
+        if self.single:
+            self.fieldMap, self.correctionMap, self.residual = self.fieldMap[0], self.correctionMap[0], self.residual[0]
+            self.stats = {key: (val[0] if isinstance(val, np.ndarray) else val) for key, val in self.stats.items()}
+        return self
+
+    def getTargetFactor(self, PosLine, iSet=0):
+        """
+        relative field per tube at a line position [mm] (mean 1 over the tubes) --> TVC.setTargetFactor()
+        poly: evaluated at PosLine, separable: step profile interpolated at PosLine
+        """
+        coef = self.coef if self.coef.ndim == 1 else self.coef[:, iSet]
+        x, y = self._coordinates(self.fieldMap.shape[-2])
+        if self.model == 'poly':
+            field = self._designPoly(np.full(len(y), float(PosLine)), y) @ coef
+        else:
+            nStep = len(x)
+            a = np.interp(PosLine, x, coef[:nStep])
+            field = np.exp(a + self._tubeProfile(y) @ coef[nStep:])
+        return field/field.mean()
+
+    def report(self):
+        print("field model: ", self.model, " degree: " if self.model == 'poly' else "", self.degree if self.model == 'poly' else "")
+        print("points: ", self.stats['nPoint'], " rms residual [%]: ", np.round(100*self.stats['rms'], 3),
+              " max |residual| [%]: ", np.round(100*self.stats['maxAbs'], 3))
+        print("tube residual [%]: ", np.round(100*self.stats['tube'], 3))
+
+
+if __name__ == "__main__":
+
+    tvc = TVC()
+    arr_uniformity, arr_uniformityErr = tvc.checkUniformity('D:/Data/Calibration_tube/test_230116/Air_Step_afterCAL_removeDummy/', True)
+    field = FieldModel(tvc, model='poly', degree=2).fit(arr_uniformity)
+    field.report()
+    tvc.setTargetFactor(field.getTargetFactor(150.0))
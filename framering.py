@@ -0,0 +1,188 @@
+###########################################
+# Shared-memory frame ring buffer between the acquisition GUI (producer) and TVC (consumer)
+# - preallocated uint16 frame slots in multiprocessing.shared_memory (same host, zero copy)
+# - header protocol per slot: sequence number, tube index, dummy flag, iteration
+# - single producer / single consumer, slots are released in order (read_seq)
+# - FramePersister: writes frames to disk asynchronously (side path), then releases the slot
+# - StandInProducer: file-writing stand-in of the acquisition GUI for tests
+###########################################
+import os
+import threading
+import queue
+from time import sleep, monotonic
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+MAGIC = 0x54564352          # 'TVCR'
+# global header (int64): magic, nSlots, Npixel_y, Npixel_x, write_seq, read_seq, closed, reserved
+H_MAGIC, H_NSLOT, H_NY, H_NX, H_WRITE, H_READ, H_CLOSED = range(7)
+N_HEADER = 8
+# slot header (int64): seq (-1: empty), iTube, isDummy, n_iter
+S_SEQ, S_TUBE, S_DUMMY, S_ITER = range(4)
+N_SLOTHEADER = 4
+POLL = 0.001                # [s]
+
+
+_created = set()            # rings created in this process (registered with its resource tracker by the producer)
+
+
+def _openSharedMemory(name, create, size=0):
+    if create:
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        _created.add(shm._name)
+        return shm
+    try:    # consumer side must not unlink the segment at exit (Python >= 3.13)
+        return shared_memory.SharedMemory(name=name, create=False, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name, create=False)
+        # Python < 3.13: the resource tracker of the consumer process would unlink the producer's ring at exit
+        if os.name == 'posix' and shm._name not in _created: resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class FrameRing():
+    def __init__(self, name=None, nSlots=8, shape=(2048, 2560), create=True):
+        """
+        create=True : producer side, allocates nSlots frames of shape (Npixel_y, Npixel_x)
+        create=False: consumer side, attaches to the ring by name (nSlots, shape are read from the header)
+        """
+        self.create = create
+        if create:
+            ny, nx = shape
+            size = 8*(N_HEADER + nSlots*N_SLOTHEADER) + 2*nSlots*ny*nx
+            self.shm = _openSharedMemory(name, True, size)
+        else:
+            self.shm = _openSharedMemory(name, False)
+        self.name = self.shm.name
+
+        self.header = np.ndarray((N_HEADER,), dtype=np.int64, buffer=self.shm.buf)
+        if create:
+            self.header[:] = [MAGIC, nSlots, shape[0], shape[1], 0, 0, 0, 0]
+        elif self.header[H_MAGIC] != MAGIC:
+            raise Exception("E20: {name} is not a TVC frame ring".format(name=name))
+        self.nSlots = int(self.header[H_NSLOT])
+        self.shape = (int(self.header[H_NY]), int(self.header[H_NX]))
+
+        offset = 8*N_HEADER
+        self.slotHeader = np.ndarray((self.nSlots, N_SLOTHEADER), dtype=np.int64, buffer=self.shm.buf, offset=offset)
+        offset += 8*self.nSlots*N_SLOTHEADER
+        self.frames = np.ndarray((self.nSlots,) + self.shape, dtype=np.uint16, buffer=self.shm.buf, offset=offset)
+        if create: self.slotHeader[:, S_SEQ] = -1
+        self.seq_next = int(self.header[H_READ])   # consumer: next frame to get()
+
+    def _wait(self, condition, timeout):
+        t_end = None if timeout is None else monotonic() + timeout
+        while not condition():
+            if t_end is not None and monotonic() > t_end: return False
+            sleep(POLL)
+        return True
+
+    # ---- producer
+    def reserve(self, timeout=None):
+        """next free slot --> seq, writable frame view (fill it in place, then commit(seq, ...))"""
+        seq = int(self.header[H_WRITE])
+        if not self._wait(lambda: seq - self.header[H_READ] < self.nSlots, timeout):
+            raise Exception("E21: no free slot in the frame ring within {t} s".format(t=timeout))
+        return seq, self.frames[seq % self.nSlots]
+
+    def commit(self, seq, iTube, isDummy, n_iter=0):
+        slot = self.slotHeader[seq % self.nSlots]
+        slot[S_TUBE], slot[S_DUMMY], slot[S_ITER] = iTube, int(isDummy), n_iter
+        slot[S_SEQ] = seq                   # slot is valid from here
+        self.header[H_WRITE] = seq + 1
+
+    def put(self, frame, iTube, isDummy, n_iter=0, timeout=None):
+        seq, view = self.reserve(timeout)
+        view[...] = frame
+        self.commit(seq, iTube, isDummy, n_iter)
+        return seq
+
+    def close(self):
+        """producer: no more frames"""
+        self.header[H_CLOSED] = 1
+
+    # ---- consumer
+    def get(self, timeout=None):
+        """
+        next frame in sequence (zero copy, valid until release(seq))
+        :return: seq, iTube, isDummy, n_iter, frame -- None if timeout or the producer closed the ring
+        """
+        seq = self.seq_next
+        slot = self.slotHeader[seq % self.nSlots]
+        if not self._wait(lambda: slot[S_SEQ] == seq or (self.header[H_CLOSED] and self.header[H_WRITE] <= seq), timeout):
+            return None
+        if slot[S_SEQ] != seq: return None
+        self.seq_next += 1
+        return seq, int(slot[S_TUBE]), bool(slot[S_DUMMY]), int(slot[S_ITER]), self.frames[seq % self.nSlots]
+
+    def release(self, seq):
+        """slot of seq can be reused by the producer (frames are released in order)"""
+        if seq != self.header[H_READ]:
+            raise Exception("E22: frame {seq} released out of order (next: {next})".format(seq=seq, next=self.header[H_READ]))
+        self.slotHeader[seq % self.nSlots, S_SEQ] = -1
+        self.header[H_READ] = seq + 1
+
+    def detach(self):
+        self.header = self.slotHeader = self.frames = None
+        self.shm.close()
+
+    def unlink(self):
+        """producer: remove the shared memory segment"""
+        self.detach()
+        self.shm.unlink()
+        _created.discard(self.shm._name)
+
+
+class FramePersister(threading.Thread):
+    """writes frames of the ring to disk in the background, then releases their slots (in order)"""
+    def __init__(self, ring):
+        super().__init__(daemon=True)
+        self.ring = ring
+        self.queue = queue.Queue()
+        self.start()
+
+    def persist(self, seq, frame, file_path):
+        """file_path None: release only"""
+        self.queue.put((seq, frame, file_path))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None: break
+            seq, frame, file_path = item
+            if file_path is not None: frame.tofile(file_path)
+            self.ring.release(seq)
+            self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
+
+    def stop(self):
+        self.flush()
+        self.queue.put(None)
+        self.join()
+
+
+class StandInProducer():
+    """
+    stand-in of the acquisition GUI for tests: one line-mode acquisition is
+    Ndummy Dummy + (shot + dummy) X (exposed tubes), pushed into the ring and/or written to a directory
+    """
+    def __init__(self, ring=None, directory=None):
+        self.ring = ring
+        self.directory = directory
+        self.cnt_file = 0
+
+    def pushAcquisition(self, list_frame, list_tube, Ndummy, dummyFrame=None, n_iter=0):
+        """list_frame: one frame per exposed tube (list_tube)"""
+        if dummyFrame is None: dummyFrame = np.zeros_like(list_frame[0])
+        for i in range(Ndummy): self._push(dummyFrame, -1, True, n_iter)
+        for frame, iTube in zip(list_frame, list_tube):
+            self._push(frame, iTube, False, n_iter)
+            self._push(dummyFrame, -1, True, n_iter)
+
+    def _push(self, frame, iTube, isDummy, n_iter):
+        if self.ring is not None: self.ring.put(frame, iTube, isDummy, n_iter)
+        if self.directory is not None:
+            np.asarray(frame, dtype=np.uint16).tofile(os.path.join(self.directory, "{n:05d}.raw".format(n=self.cnt_file)))
+        self.cnt_file += 1
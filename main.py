@@ -13,42 +13,127 @@ import csv
 import matplotlib as m
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
-from datetime import date
+from datetime import date, datetime
+from resultcache import ResultCache
+
+# geometry config: every tube count / detector size / file layout dependent value is derived from here
+GEOMETRY_DEFAULT = {
+    'Npixel_x': 2560,           # Tube array가 이동하는 방향
+    'Npixel_y': 2048,           # Tube array 방향
+    'ActiveArea_x_max': 2350,   # collimator로 짤리는 영역 y_max
+    'SizePixel': 0.124,         # [mm]
+    'Ntube': 7,
+    'PitchTube': 30.0,          # [mm]
+    'SizeStep': 30.0,           # [mm]
+    'SID': 400.0,               # [mm]
+    'Ndummy': 11,               # leading dummy files before the (shot + dummy) pairs
+    'HalfROI': 50,              # half size of ROI [pixel]
+}
 
 class TVC():
-    def __init__(self):
+    def __init__(self, geometry=None):
         self.DEBUG = False
 
         self.LOGfile_indxCurr = 'LOG_indxCurr.csv'
         self.LOGfile_intst = 'LOG_intst.csv'
-        # detector parameters
-        self.CONST_Npixel_x = 2560        # Tube array가 이동하는 방향
-        self.CONST_Npixel_y = 2048        # Tube array 방향
-        self.CONST_ActiveArea_x_max = 2350      # collimator로 짤리는 영역 y_max
-
-        self.CONST_SizePixel = 0.124      #[mm]
-        # tube array parameters
-        self.CONST_Ntube = 7
-        self.CONST_PitchTube = 30.0       #[mm]
-        self.CONST_SizeStep = 30.0        #[mm]
-        self.CONST_SID = 400.0            #[mm]
+        self.LOGfile_intstErr = 'LOG_intstErr.csv'      # standard error of the ROI mean
+        self.LOGfile_exposeTube = 'LOG_exposeTube.csv'  # exposed (1) or not (0) per tube and acquisition (PARTIAL)
+        self.LOGfile_finished = 'LOG_finished.csv'      # CAL finished (1) or not (0) per run(): a new DAC row follows if 0
         self.PositionTube = None    # need to be set by setPosTube()
-        self.initVariables()
 
         # Variables which should be defined in advance
         self.waitingTime = 100
         self.targetIntensity = 3700                     # Need to be defined
         self.limitVariation = 0.03                      # Target +/-3%
-        self.list_DAC_LSB = [9.13]*self.CONST_Ntube     # intensity increase per 1 DAC
-        self.CONST_Nfiles = 25                          # 11 Dummy + (shot + dummy)X7
+        self.DAC_LSB_default = 9.13                     # intensity increase per 1 DAC
+        self.DAC_deadband = 5                           # |DAC step| <= DAC_deadband: keep current DAC index
+        self.confidenceZ = 1.96                         # z of the confidence test (1.96: 95%, two-sided)
+        self.sigmaShot = 0.003                          # relative shot-to-shot reproducibility of tube output (estimateSigmaShot())
+        self.LOCALIZE = False                           # True: ROI center from the detected tube footprint
+        self.targetRule = 'trimmed_mean'                # rule of _calculateNewTarget()
+        self.minValidTubes = 3                          # min. # of tubes (passed QC) for _calculateNewTarget()
+        self.PARTIAL = False                            # True: re-expose only tubes out of tolerance
+        self.frameRing, self.framePersister = None, None    # set by setFrameRing()
+        self.uniformityCache = None                     # set by setUniformityCache()
+        self.recorder = None                            # regression.SessionRecorder, set by setRecorder()
+        # PREVIEW: checkUniformity() and DEBUG views on strided samples / binned thumbnails (run() stays full precision)
+        self.PREVIEW = False
+        self.previewStride = 4                          # ROI sampling: every 4th pixel in both directions
+        self.previewBin = 8                             # thumbnail: 8x8 block mean
+        self.ArchiveON = False
+        # frame QC on arrival (setQCmode()): 'flag' (failed tubes keep their DAC index), 'abort' (raise E05), None (off)
+        self.QCmode = None
+        self.qcMaxRetry = 3                             # 'flag': a tube failing QC in qcMaxRetry acquisitions in a row --> E05
+        self.qcStride = 16                              # sparse sampling of the frame
+        self.qcDarkLevel = 100                          # mean of the sampled frame / pixel value < qcDarkLevel: dark
+        self.qcSaturationLevel = 16383                  # pixel value >= qcSaturationLevel: saturated (14 bit)
+        self.qcMaxFraction = 0.01                       # max. fraction of saturated / underexposed pixels in ROI
+        self.qcMisalignRatio = 0.5                      # ROI mean < qcMisalignRatio x footprint peak: misaligned
+        self.qcSettleTime = 5                           # [s] QC abort: no new file / frame --> acquisition stopped
+        self.setGeometry(geometry)
+
+    def setGeometry(self, geometry=None):
+        """
+        set detector / tube array geometry from a config dict (missing keys: GEOMETRY_DEFAULT)
+        and rebuild all derived values (tube centers, file layout, per-tube state arrays)
+        """
+        self.geometry = dict(GEOMETRY_DEFAULT)
+        if geometry is not None:
+            unknown = set(geometry) - set(GEOMETRY_DEFAULT)
+            if unknown: raise Exception("E02: unknown geometry parameters: {keys}".format(keys=sorted(unknown)))
+            self.geometry.update(geometry)
+        g = self.geometry
+        # detector parameters
+        self.CONST_Npixel_x = int(g['Npixel_x'])
+        self.CONST_Npixel_y = int(g['Npixel_y'])
+        self.CONST_ActiveArea_x_max = int(g['ActiveArea_x_max'])
+        self.CONST_SizePixel = float(g['SizePixel'])
+        self.CONST_HalfROI = int(g['HalfROI'])
+        # tube array parameters
+        self.CONST_Ntube = int(g['Ntube'])
+        self.CONST_PitchTube = float(g['PitchTube'])
+        self.CONST_SizeStep = float(g['SizeStep'])
+        self.CONST_SID = float(g['SID'])
+        # file layout: Ndummy Dummy + (shot + dummy) X Ntube
+        self.CONST_Ndummy = int(g['Ndummy'])
+        self.CONST_Nfiles = self.CONST_Ndummy + 2*self.CONST_Ntube
+
+        self.arr_DAC_LSB = np.full(self.CONST_Ntube, self.DAC_LSB_default, dtype=float)
+        self.arr_targetFactor = np.ones(self.CONST_Ntube)
+        self._calculateTubeCenter()
+        self.dict_tubeCenter = {}    # detected tube centers per line position, filled by _getTubeCenter()
+        self.initVariables()
 
     def initVariables(self):
         """initialize status variables"""
         self.n_iter = 0
         self.status_CALfinished=False
         self.status_running=False
-        self.list_indxCurr_diff=[0]*self.CONST_Ntube
-        self.list_intst_prev=[0]*self.CONST_Ntube
+        self.arr_indxCurr_diff = np.zeros(self.CONST_Ntube, dtype=int)
+        self.arr_intst_prev = np.zeros(self.CONST_Ntube, dtype=float)
+        self.arr_intstErr = np.zeros(self.CONST_Ntube, dtype=float)
+        self.arr_intstErr_prev = np.zeros(self.CONST_Ntube, dtype=float)
+        self._setExposeTube(np.ones(self.CONST_Ntube, dtype=bool))
+        self.arr_QCfailCount = np.zeros(self.CONST_Ntube, dtype=int)    # consecutive acquisitions with failed QC
+        self._initQC()
+
+    def _setExposeTube(self, arr_expose):
+        """
+        tubes to be exposed in the next acquisition (bool array of size CONST_Ntube)
+        --> expected file layout: Ndummy Dummy + (shot + dummy) X (# of exposed tubes)
+        """
+        self.arr_exposeTube = np.asarray(arr_expose, dtype=bool)
+        nExpose = int(self.arr_exposeTube.sum())
+        self.Nfiles = self.CONST_Ndummy + 2*nExpose
+        self.indx_datafiles = self.CONST_Ndummy + 2*np.arange(nExpose)
+
+    def getExposeTube(self):
+        """
+        return tube indices which have to be exposed in the next acquisition
+        PARTIAL off: all tubes
+        PARTIAL on : tubes out of tolerance after run() (all tubes at n_iter == 0 and after CAL finished)
+        """
+        return np.flatnonzero(self.arr_exposeTube).tolist()
 
     def _createDir(self, dirPath):
         if not os.path.exists(dirPath):
@@ -82,10 +167,10 @@ class TVC():
     def _calculateTubeCenter(self): #--> output: self.r_tubes
         pitch_idx = self.CONST_PitchTube / self.CONST_SizePixel
         indx_s = int(int(self.CONST_Npixel_y / 2) - int(self.CONST_Ntube / 2) * pitch_idx - 0.5 * pitch_idx * (self.CONST_Ntube % 2 - 1))
-        self.r_tubes = [int(indx_s + i*pitch_idx) for i in range(self.CONST_Ntube)]
+        self.r_tubes = (indx_s + np.arange(self.CONST_Ntube)*pitch_idx).astype(int)
         # Need to check the order of the tube center according to iTube
-        #self.r_tubes.reverse()
-        print("self.r_tubes = ", self.r_tubes)
+        #self.r_tubes = self.r_tubes[::-1]
+        if self.DEBUG: print("self.r_tubes = ", self.r_tubes)
 
     def setDEBUG_ON(self):
         self.DEBUG = True
@@ -93,14 +178,44 @@ class TVC():
     def setDEBUG_OFF(self):
         self.DEBUG = False
 
+    def setPARTIAL_ON(self):
+        self.PARTIAL = True
+
+    def setPARTIAL_OFF(self):
+        self.PARTIAL = False
+
+    def setPREVIEW_ON(self):
+        self.PREVIEW = True
+
+    def setPREVIEW_OFF(self):
+        self.PREVIEW = False
+
+    def setLOCALIZE_ON(self):
+        self.LOCALIZE = True
+
+    def setLOCALIZE_OFF(self):
+        self.LOCALIZE = False
+
+    def clearTubeCenter(self):
+        self.dict_tubeCenter = {}
+
     def setTarget(self, val): #val: intensity
         self.targetIntensity = int(val)
 
+    def setTargetFactor(self, arr_factor): # relative target per tube (ex, fieldmodel.FieldModel.getTargetFactor())
+        arr_factor = np.asarray(arr_factor, dtype=float)
+        if len(arr_factor) != self.CONST_Ntube:
+            raise Exception("E00: The number of target factors is not the same as the number of tubes.")
+        self.arr_targetFactor = arr_factor
+
+    def _getTarget(self):
+        """target intensity per tube: targetIntensity x arr_targetFactor (smooth field correction)"""
+        return self.targetIntensity*self.arr_targetFactor
+
     def setPosLine(self, val): # val = position of Tube array [mm]   0-150 mm
-        self._calculateTubeCenter()  # calculate Tube centers
+        # Tube centers (self.r_tubes) are calculated once in setGeometry()
         self.c_tibes = int(int(val)/self.CONST_SizePixel)
-        print(self.r_tubes)
-        print(self.c_tibes)
+        if self.DEBUG: print(self.r_tubes, self.c_tibes)
 
     def setTubeVoltage(self, val): # val = tube voltage (ex, 60: 60kV)
         self.tVol = int(val)
@@ -129,9 +244,10 @@ class TVC():
 
 
     def setCurrentIndex(self, list_indxCurr):
-        self._addDateIterINFO(list_indxCurr)
-        self._writeCSV(self.DirectoryLog + self.LOGfile_indxCurr, list_indxCurr)
-        self.list_indxCurr = list_indxCurr[2:]
+        # logged by run() after the acquisition was read: a run aborted by E01 / E05 leaves no row in LOG_indxCurr
+        if len(list_indxCurr) != self.CONST_Ntube:
+            raise Exception("E00: The number of Current index is not the same as the number of tubes.")
+        self.arr_indxCurr = np.asarray(list_indxCurr, dtype=int)
 
 
     def _checkALLFilesSaved(self, directory):
@@ -139,33 +255,136 @@ class TVC():
         while cnt<self.waitingTime:
             sleep(1)
             cnt += 1
-            self.fileList = os.listdir(directory)
-            if len(self.fileList) >= self.CONST_Nfiles: return True
+            self.fileList = sorted(os.listdir(directory))
+            self.nArrived = len(self.fileList)
+            allSaved = len(self.fileList) >= self.Nfiles
+            self._checkArrivedFilesQC(directory, allSaved)  # QC of data files as soon as they are complete
+            if allSaved: return True
 
-        if cnt >= 10: raise Exception("E01: we cannot find {N} files in {dir}".format(N=self.Ntube, dir=self.DirectoryCAL))
+        if cnt >= 10: raise Exception("E01: we cannot find {N} files in {dir}".format(N=self.Nfiles, dir=directory))
         return False
 
     def _deleteDummyFiles(self):
-        if not len(self.fileList) >= self.CONST_Nfiles:
-            raise Exception("Warning!!! len(self.fileList) != 25, please check # of files in the CAL directory")
-        # select first 25 files in fileList (18 Dummy files + 7 Data files)
-        self.fileList = self.fileList[:self.CONST_Nfiles]
-        list_datafile = []
-
-        for i, f in enumerate(self.fileList):
-            if i<11:
-                if (self.ArchiveON): self._moveFileArchive(f)
-            else:
-                if i%2 == 0:
-                    if (self.ArchiveON): self._moveFileArchive(f)
-                else:
-                    list_datafile.append(f)
-
-        self.fileList = list_datafile
-        if len(self.fileList) == self.CONST_Ntube: return True
+        if not len(self.fileList) >= self.Nfiles:
+            raise Exception("Warning!!! len(self.fileList) != {N}, please check # of files in the CAL directory".format(N=self.Nfiles))
+        # select first Nfiles files in fileList (Dummy files + Data files of exposed tubes), data at self.indx_datafiles
+        fileList = self.fileList[:self.Nfiles]
+        mask_data = np.zeros(self.Nfiles, dtype=bool)
+        mask_data[self.indx_datafiles] = True
+
+        if (self.ArchiveON):
+            for f, isData in zip(fileList, mask_data):
+                if not isData: self._moveFileArchive(f)
+
+        self.fileList = [fileList[i] for i in self.indx_datafiles]
+        if len(self.fileList) == len(self.indx_datafiles): return True
         return False
 
 
+    def setQCmode(self, mode): # mode = 'flag', 'abort' or None
+        if mode not in ('flag', 'abort', None): raise Exception("E05: unknown QC mode: {mode}".format(mode=mode))
+        self.QCmode = mode
+
+    def getQCresult(self):
+        """return list of (iTube, reason) of frames which failed QC in the last acquisition"""
+        return self.list_QCfail
+
+    def _initQC(self):
+        self.arr_QCfail = np.zeros(self.CONST_Ntube, dtype=bool)
+        self.arr_QCchecked = np.zeros(len(self.indx_datafiles), dtype=bool)
+        self.list_QCfail = []
+
+    def _checkFrameQC(self, iTube, data2D):
+        """
+        lightweight QC of one frame (sparse sampling + ROI only, data2D can be a np.memmap)
+        :return: reason of failure, None if the frame is OK
+        """
+        s = self.qcStride
+        sample = np.asarray(data2D[::s, :self.CONST_ActiveArea_x_max:s], dtype=float)
+        if sample.mean() < self.qcDarkLevel: return "dark frame (mean {m:.0f})".format(m=sample.mean())
+
+        r_tube, c_tube = self.r_tubes[iTube], self.c_tibes
+        centers = self.dict_tubeCenter.get(self.c_tibes)
+        if self.LOCALIZE and centers is not None and not np.isnan(centers[iTube, 0]):
+            r_tube, c_tube = int(round(centers[iTube, 0])), int(round(centers[iTube, 1]))
+        i_min, i_max, j_min, j_max = self._getROI(r_tube, c_tube)
+        dataROI = np.asarray(data2D[i_min:i_max, j_min:j_max], dtype=float)
+        if dataROI.size == 0: return "empty ROI"
+        f_sat = np.mean(dataROI >= self.qcSaturationLevel)
+        if f_sat > self.qcMaxFraction: return "saturated ROI ({f:.1%} of pixels)".format(f=f_sat)
+        f_under = np.mean(dataROI < self.qcDarkLevel)
+        if f_under > self.qcMaxFraction: return "underexposed ROI ({f:.1%} of pixels)".format(f=f_under)
+        peak = np.percentile(sample, 99)
+        if dataROI.mean() < self.qcMisalignRatio*peak:
+            return "misaligned ROI (ROI mean {m:.0f}, footprint peak {p:.0f})".format(m=dataROI.mean(), p=peak)
+        return None
+
+    def _checkFileQC(self, iTube, file_path):
+        nBytes = 2*self.CONST_Npixel_y*self.CONST_Npixel_x
+        size = os.path.getsize(file_path)
+        if size != nBytes: return "truncated file ({n} of {N} bytes)".format(n=size, N=nBytes)
+        data2D = np.memmap(file_path, dtype=np.uint16, mode='r', shape=(self.CONST_Npixel_y, self.CONST_Npixel_x))
+        reason = self._checkFrameQC(iTube, data2D)
+        del data2D  # release the file before it is moved to the archive
+        return reason
+
+    def _checkArrivedFilesQC(self, directory, allSaved):
+        """QC of the data files in self.fileList which are complete (expected size, next file exists or all saved)"""
+        if self.QCmode is None: return
+        nBytes = 2*self.CONST_Npixel_y*self.CONST_Npixel_x
+        list_tube = np.flatnonzero(self.arr_exposeTube)
+        for k, i in enumerate(self.indx_datafiles):
+            if self.arr_QCchecked[k] or i >= len(self.fileList): continue
+            file_path = directory + self.fileList[i]
+            if not (allSaved or i + 1 < len(self.fileList) or os.path.getsize(file_path) == nBytes): continue
+            self.arr_QCchecked[k] = True
+            reason = self._checkFileQC(list_tube[k], file_path)
+            if reason is not None: self._failQC(list_tube[k], reason)
+
+    def _failQC(self, iTube, reason):
+        print("!!! QC failed !!! tube {i}: {reason}".format(i=iTube, reason=reason))
+        self.arr_QCfail[iTube] = True
+        self.list_QCfail.append((int(iTube), reason))
+        self.arr_QCfailCount[iTube] += 1
+        if self.QCmode == 'abort':
+            self._clearAcquisition()
+            raise Exception("E05: frame QC failed -- tube {i}: {reason}, please expose again".format(i=iTube, reason=reason))
+        if self.arr_QCfailCount[iTube] >= self.qcMaxRetry:
+            self._clearAcquisition()
+            raise Exception("E05: frame QC of tube {i} failed in {n} acquisitions in a row ({reason}), please check the tube / QC parameters".format(
+                i=iTube, n=self.arr_QCfailCount[iTube], reason=reason))
+
+    def _clearAcquisition(self):
+        """
+        QC abort: the rest of the aborted acquisition must not be read by the next run()
+        files in the CAL directory are moved to the archive, frames of the ring are released,
+        until all Nfiles of the acquisition arrived or no new file / frame arrived for qcSettleTime [s]
+        """
+        if self.frameRing is not None:
+            while self.nArrived < self.Nfiles:
+                item = self.frameRing.get(timeout=self.qcSettleTime)
+                if item is None: break
+                seq, iTube, isDummy, n_iter, frame = item
+                self._releaseFrame(seq, iTube, isDummy, frame)
+                self.nArrived += 1
+            return
+        if not self.ArchiveON: return
+        nBytes = 2*self.CONST_Npixel_y*self.CONST_Npixel_x
+        nMoved, cnt_idle = 0, 0
+        while True:
+            fileList = sorted(os.listdir(self.DirectoryCAL))
+            allArrived = self.nArrived >= self.Nfiles or cnt_idle >= self.qcSettleTime
+            moved = 0
+            for k, f in enumerate(fileList):   # the last file can still be written
+                if allArrived or k + 1 < len(fileList) or os.path.getsize(self.DirectoryCAL + f) == nBytes:
+                    self._moveFileArchive(f)
+                    moved += 1
+            nMoved += moved
+            if allArrived or nMoved >= self.Nfiles: break
+            cnt_idle = 0 if moved else cnt_idle + 1
+            sleep(1)
+        print("--- {n} files of the aborted acquisition were moved to the archive".format(n=nMoved))
+
     def _readData(self, file_path):
         with open(file_path, 'rb') as input_file:  # 16-bit unsigned
             fileContent = input_file.read()
@@ -175,9 +394,25 @@ class TVC():
             data_2D = np.reshape(data_1D, (self.CONST_Npixel_y, self.CONST_Npixel_x))
         return data_2D
 
+    def _readDataPreview(self, file_path):
+        """PREVIEW: memory-mapped frame, only the sampled pixels are read from disk"""
+        return np.memmap(file_path, dtype=np.uint16, mode='r', shape=(self.CONST_Npixel_y, self.CONST_Npixel_x))
+
+    def _binFrame(self, data_2D, b):
+        """block-reduced (b x b mean) thumbnail of a frame"""
+        ny, nx = (data_2D.shape[0] // b)*b, (data_2D.shape[1] // b)*b
+        return np.asarray(data_2D[:ny, :nx], dtype=float).reshape(ny // b, b, nx // b, b).mean(axis=(1, 3))
+
+    def _imshow(self, data_2D):
+        """imshow() of a frame, binned by previewBin in PREVIEW (axes stay in full resolution pixel index)"""
+        b = self.previewBin
+        if not self.PREVIEW or min(data_2D.shape) < 8*b: return plt.imshow(data_2D)
+        ny, nx = (data_2D.shape[0] // b)*b, (data_2D.shape[1] // b)*b
+        return plt.imshow(self._binFrame(data_2D, b), extent=(-0.5, nx - 0.5, ny - 0.5, -0.5))
+
     def _showImage(self, data_2D, xx=[], yy=[], style='-r', tit='DATA name', xl='x_index', yl='y_index', saveOption=False):
         plt.subplots(figsize=(14, 10))
-        plt.imshow(data_2D)
+        self._imshow(data_2D)
         if len(xx)>0 : plt.plot(xx, yy, style)
         plt.colorbar()
         plt.clim(2700, 3250)
@@ -189,7 +424,7 @@ class TVC():
 
     def _showImage_rect(self, data_2D, x_min, x_max, y_min, y_max):
         plt.subplots(figsize=(14, 10))
-        plt.imshow(data_2D)
+        self._imshow(data_2D)
         plt.gca().add_patch(Rectangle((y_min, x_min), int(y_max-y_min), int(x_max-x_min), linewidth=2, edgecolor='r', facecolor='none'))
         plt.colorbar()
         plt.xlabel("x_index")
@@ -198,26 +433,79 @@ class TVC():
         plt.show()
 
 
-    def _getIntensity(self, iTube, data2D):
-        i_min = int(max(0, (self.r_tubes[iTube] - 50)))
-        i_max = int(min((self.r_tubes[iTube] + 50), self.CONST_Npixel_y))
-        j_min = int(max(0, (self.c_tibes - 50)))
-        j_max = int(min((self.c_tibes + 50), self.CONST_ActiveArea_x_max))
+    def _getProjectionProfiles(self, data2D):
+        """row (tube array direction) and column (moving direction) mean profiles of the active area"""
+        frame = np.asarray(data2D[:, :self.CONST_ActiveArea_x_max], dtype=float)
+        return frame.mean(axis=1), frame.mean(axis=0)
+
+    def _findFootprintPeak(self, profile, arr_nominal, halfWindow):
+        """
+        peak of the tube footprint in a profile, searched within +/- halfWindow around the nominal centers
+        profile is smoothed with the ROI size, so the peak is the position with the highest ROI mean
+        :return: sub-pixel peak positions (parabolic interpolation), one per nominal center
+        """
+        # moving mean over the in-range samples only (no zero padding at the detector edges)
+        kernel = np.ones(2*self.CONST_HalfROI + 1)
+        smooth = np.convolve(profile, kernel, mode='same') / np.convolve(np.ones(len(profile)), kernel, mode='same')
+        nominal = np.atleast_1d(np.asarray(arr_nominal, dtype=int))
+        idx = np.clip(nominal[:, None] + np.arange(-halfWindow, halfWindow + 1)[None, :], 1, len(smooth) - 2)
+        i_peak = idx[np.arange(len(nominal)), np.argmax(smooth[idx], axis=1)]
+
+        y0, y1, y2 = smooth[i_peak - 1], smooth[i_peak], smooth[i_peak + 1]
+        denom = y0 - 2*y1 + y2
+        delta = np.zeros(len(i_peak))
+        curved = denom < 0
+        delta[curved] = 0.5*(y0[curved] - y2[curved])/denom[curved]
+        return i_peak + np.clip(delta, -0.5, 0.5)
+
+    def _getTubeCenter(self, iTube, data2D):
+        """
+        ROI center (row, column) of iTube
+        LOCALIZE off: nominal geometry (self.r_tubes, self.c_tibes)
+        LOCALIZE on : footprint detected from data2D, cached per line position and reused by later frames
+        """
+        if not self.LOCALIZE: return self.r_tubes[iTube], self.c_tibes
+
+        centers = self.dict_tubeCenter.setdefault(self.c_tibes, np.full((self.CONST_Ntube, 2), np.nan))
+        if np.isnan(centers[iTube, 0]):
+            profile_r, profile_c = self._getProjectionProfiles(data2D)
+            halfWindow_r = int(0.5*self.CONST_PitchTube/self.CONST_SizePixel)
+            halfWindow_c = int(0.5*self.CONST_SizeStep/self.CONST_SizePixel)
+            centers[iTube, 0] = self._findFootprintPeak(profile_r, self.r_tubes[iTube], halfWindow_r)[0]
+            centers[iTube, 1] = self._findFootprintPeak(profile_c, min(self.c_tibes, len(profile_c) - 1), halfWindow_c)[0]
+            print(iTube, "--- tube center was detected: ", (self.r_tubes[iTube], self.c_tibes), " --> ", centers[iTube])
+        return int(round(centers[iTube, 0])), int(round(centers[iTube, 1]))
+
+    def _getROI(self, r_tube, c_tube):
+        hw = self.CONST_HalfROI
+        i_min = int(max(0, (r_tube - hw)))
+        i_max = int(min((r_tube + hw), self.CONST_Npixel_y))
+        j_min = int(max(0, (c_tube - hw)))
+        j_max = int(min((c_tube + hw), self.CONST_ActiveArea_x_max))
 
         if j_max<j_min:
             j_min = j_max
+        return i_min, i_max, j_min, j_max
+
+    def _getIntensity(self, iTube, data2D, stride=1):
+        """
+        mean intensity in ROI of iTube and its standard error
+        stride > 1 (PREVIEW): every stride-th pixel in both directions, the standard error is the bound of the sampling
+        """
+        i_min, i_max, j_min, j_max = self._getROI(*self._getTubeCenter(iTube, data2D))
 
         if self.DEBUG: self._showImage_rect(data2D, i_min, i_max, j_min, j_max)
 
-        dataROI = data2D[i_min:i_max, j_min:j_max]
-        dataROI.flatten().astype("int")
+        dataROI = np.asarray(data2D[i_min:i_max:stride, j_min:j_max:stride], dtype=float)
         dataROI = dataROI[~np.isnan(dataROI)]
         dataROI = dataROI[dataROI>0]
         print("x_min, x_max, y_min, y_max: ", i_min, i_max, j_min, j_max, len(dataROI))
-        if len(dataROI)>0: iI = int(np.mean(dataROI))
-        else: iI = 0
-        if self.DEBUG: print(iTube, "x_min, x_max: ", i_min, i_max, "  -- y_min, y_max: ", j_min, j_max, " --- mean of intensity in ROI: ", iI)
-        return iI, i_min, i_max, j_min, j_max
+        # mean and its standard error in ROI
+        if len(dataROI)>1: iI, iErr = dataROI.mean(), dataROI.std(ddof=1)/np.sqrt(len(dataROI))
+        elif len(dataROI)==1: iI, iErr = dataROI[0], 0.0
+        else: iI, iErr = 0.0, 0.0
+        if self.DEBUG: print(iTube, "x_min, x_max: ", i_min, i_max, "  -- y_min, y_max: ", j_min, j_max, " --- mean of intensity in ROI: ", iI, " +/- ", iErr)
+        return iI, iErr, i_min, i_max, j_min, j_max
 
     def _addDateIterINFO(self, list):
         today = date.today()
@@ -244,77 +532,224 @@ class TVC():
         os.rename(src, dst)
 
     def _getListIntensity(self, directory):
-        today = date.today()
-        d = today.strftime("%Y-%m-%d")
-        list_intst = []
+        # tubes which were not exposed (PARTIAL) keep their last intensity (and its standard error)
+        arr_intst = np.where(self.arr_exposeTube, 0.0, self.arr_intst_prev)
+        self.arr_intstErr = np.where(self.arr_exposeTube, 0.0, self.arr_intstErr_prev)
+        self._initQC()
+        self.nArrived = 0   # files / frames of this acquisition (dummy + data)
+        if self.frameRing is not None:  # frames from the shared-memory ring instead of the CAL directory
+            self.list_framePath = []
+            self._getListIntensityRing(arr_intst)
+            self._checkIntensityQC(arr_intst)
+            self._writeLogIntensity(arr_intst)
+            return arr_intst
         # need to set position of Line(tube array) using setPosLine()
         # Case_01 : check if all files were saved after line-mode exposure
-        if self._checkALLFilesSaved(directory):  # len(fileList) >= 25: Dummy Files + data Files
-            if self._deleteDummyFiles():  # taking first 25 files and delete Dummy file --> len(fileList) == 7 : TVC starts
-                for iTube, f in enumerate(self.fileList):
-                    print(iTube, self.DirectoryCAL + f)
+        if self._checkALLFilesSaved(directory):  # len(fileList) >= Nfiles: Dummy Files + data Files
+            if self._deleteDummyFiles():  # taking first Nfiles files and delete Dummy file --> one data file per exposed tube : TVC starts
+                for iTube, f in zip(np.flatnonzero(self.arr_exposeTube), self.fileList):
+                    if self.DEBUG: print(iTube, directory + f)
                     img = self._readData(directory + f)
-                    intensity, x_min, x_max, y_min, y_max = self._getIntensity(iTube, img)
+                    arr_intst[iTube], self.arr_intstErr[iTube], x_min, x_max, y_min, y_max = self._getIntensity(iTube, img)
                     if self.DEBUG: self._showImage_rect(img, x_min, x_max, y_min, y_max)
-                    list_intst.append(intensity)
-                self._addDateIterINFO(list_intst)
-                self._writeCSV(self.DirectoryLog + self.LOGfile_intst, list_intst)
+                self._checkIntensityQC(arr_intst)
+                self._writeLogIntensity(arr_intst)
                 if (self.ArchiveON): self._moveFilesArchive()
+                self.list_framePath = [(self.DirectoryArchive if self.ArchiveON else directory) + f for f in self.fileList]
             else:
-                raise Exception("False from self._deleteDummyFiles(): please check # of files which should be 7 in CAL directory")
+                raise Exception("False from self._deleteDummyFiles(): please check # of files which should be {N} in CAL directory".format(N=len(self.indx_datafiles)))
         else:
-            raise Exception("False from self._checkALLFilesSaved(): please check # of files which should be 25 in CAL directory")
-
-        return list_intst[2:]
-
-    def _calculateNewTarget(self, list_intst):
-        list_intensity = [i for i in list_intst]
-        list_intensity.sort()
-        new_target = sum(list_intensity[1:-1])/len(list_intensity[1:-1])
+            raise Exception("False from self._checkALLFilesSaved(): please check # of files which should be {N} in CAL directory".format(N=self.Nfiles))
+
+        return arr_intst
+
+    def _checkIntensityQC(self, arr_intst):
+        """exposed tubes without intensity (empty ROI) --> QC failed"""
+        if self.QCmode is None: return
+        for iTube in np.flatnonzero(self.arr_exposeTube & ~self.arr_QCfail & (arr_intst <= 0)):
+            self._failQC(iTube, "no intensity in ROI")
+        self.arr_QCfailCount[self.arr_exposeTube & ~self.arr_QCfail] = 0
+        # failed tubes keep their last intensity, they are not used for the DAC update
+        arr_intst[self.arr_QCfail] = self.arr_intst_prev[self.arr_QCfail]
+        self.arr_intstErr[self.arr_QCfail] = self.arr_intstErr_prev[self.arr_QCfail]
+
+    def _writeLogIntensity(self, arr_intst):
+        # tubes which failed QC have no measurement in this acquisition: logged as nan (exposed in LOG_exposeTube)
+        arr_intst = np.where(self.arr_QCfail, np.nan, arr_intst)
+        arr_intstErr = np.where(self.arr_QCfail, np.nan, self.arr_intstErr)
+        self._writeCSV(self.DirectoryLog + self.LOGfile_intst, self._addDateIterINFO(np.round(arr_intst, 2).tolist()))
+        self._writeCSV(self.DirectoryLog + self.LOGfile_intstErr, self._addDateIterINFO(np.round(arr_intstErr, 3).tolist()))
+        self._writeCSV(self.DirectoryLog + self.LOGfile_exposeTube, self._addDateIterINFO(self.arr_exposeTube.astype(int).tolist()))
+
+    def setFrameRing(self, ring, persist=True):
+        """
+        read frames from a framering.FrameRing (shared memory) instead of the CAL directory
+        persist: archived frames are written to DirectoryArchive in the background (framering.FramePersister)
+        ring None: back to the CAL directory
+        """
+        if self.framePersister is not None: self.framePersister.stop()
+        self.frameRing, self.framePersister = ring, None
+        self.ringStamp = datetime.now().strftime("%Y%m%d%H%M%S")   # archived frames: ring stamp + seq sort in acquisition order
+        if ring is not None and persist:
+            from framering import FramePersister
+            self.framePersister = FramePersister(ring)
+
+    def _getListIntensityRing(self, arr_intst):
+        """intensities of the exposed tubes from the next frames of the ring (dummy frames are skipped)"""
+        list_tube = np.flatnonzero(self.arr_exposeTube)
+        received = np.zeros(self.CONST_Ntube, dtype=bool)
+        while not received[list_tube].all():
+            item = self.frameRing.get(timeout=self.waitingTime)
+            if item is None: raise Exception("E01: we cannot get {N} frames from the frame ring".format(N=len(list_tube)))
+            seq, iTube, isDummy, n_iter, frame = item
+            if n_iter != self.n_iter:
+                if n_iter > self.n_iter:
+                    raise Exception("E04: frame {seq} of iteration {n} was not expected at iteration {N}".format(seq=seq, n=n_iter, N=self.n_iter))
+                # frame of an earlier acquisition (ex, trailing dummy)
+                if self.DEBUG: print("--- frame {seq} of iteration {n} was skipped".format(seq=seq, n=n_iter))
+                self._releaseFrame(seq, iTube, isDummy, frame)
+                continue
+            self.nArrived += 1
+            reason = None
+            if not isDummy:
+                if not self.arr_exposeTube[iTube]: raise Exception("E04: frame of tube {i} was not expected".format(i=iTube))
+                if self.QCmode is not None: reason = self._checkFrameQC(iTube, frame)
+                if reason is None:
+                    arr_intst[iTube], self.arr_intstErr[iTube], x_min, x_max, y_min, y_max = self._getIntensity(iTube, frame)
+                    if self.DEBUG: self._showImage_rect(frame, x_min, x_max, y_min, y_max)
+                received[iTube] = True
+            self._releaseFrame(seq, iTube, isDummy, frame)
+            if reason is not None: self._failQC(iTube, reason)
+
+    def _releaseFrame(self, seq, iTube, isDummy, frame):
+        if self.framePersister is None:
+            self.frameRing.release(seq)
+            return
+        file_path = None
+        if self.ArchiveON:
+            fname = "{stamp}_{seq:09d}_itr{n:03d}_{kind}.raw".format(stamp=self.ringStamp, seq=seq, n=self.n_iter,
+                                                                    kind='dummy' if isDummy else 'tube{i}'.format(i=iTube))
+            file_path = self.DirectoryArchive + fname
+        self.framePersister.persist(seq, frame, file_path)
+
+    def _calculateNewTarget(self, arr_intst):
+        # self.targetRule: 'trimmed_mean' (drop min/max), 'median', 'mean' -- of field corrected intensities
+        # tubes which failed QC have no valid intensity and are not used for the target
+        valid = ~self.arr_QCfail
+        if valid.sum() < self.minValidTubes:
+            raise Exception("E06: only {n} tubes passed QC, {N} are needed for the target intensity".format(
+                n=int(valid.sum()), N=self.minValidTubes))
+        arr_intensity = np.sort(np.asarray(arr_intst)[valid]/self.arr_targetFactor[valid])
+        if self.targetRule == 'trimmed_mean': new_target = arr_intensity[1:-1].mean()
+        elif self.targetRule == 'median': new_target = np.median(arr_intensity)
+        elif self.targetRule == 'mean': new_target = arr_intensity.mean()
+        else: raise Exception("E03: unknown target rule: {rule}".format(rule=self.targetRule))
         print("---- set NEW target to self.Target: ", self.targetIntensity, '  -->  ', new_target)
         self.setTarget(new_target)
 
 
 
     def _calculateNewIndxCurr(self):
+        """
+        new DAC index for all tubes at once (arrays of size CONST_Ntube)
+        - 1st update of a tube (no previous DAC step): newIndx as calculated
+        - |diff| <= DAC_deadband: keep the current DAC index
+        - diff changes its sign (overshoot): update DAC_LSB from the last step and recalculate newIndx
+        """
         print(self.n_iter, "--- Calculate New DAC index for Current ---")
 
-        newIndxCurr_original = []
-        newIndxCurr = []
+        arr_indxCurr, arr_intst = self.arr_indxCurr, self.arr_intst
+        diff_target = arr_intst - self._getTarget()
+        newIndxCurr_original, newIndxCurr = self._updateIndxCurr()
         print("id, intensity, DAC_orig, diff_target, DAC_diff, NEW DAC")
-        for i, intst in enumerate(self.list_intst):
-            newIndx = int(self.list_indxCurr[i] - (intst - self.targetIntensity)/self.list_DAC_LSB[i])
-            diff = newIndx - self.list_indxCurr[i]
-            newIndxCurr_original.append(newIndx)
-
-            if not self.list_indxCurr_diff[i] == 0: # (n_iter == 0: newIndx 계산값 그대로 적용하는 경우)를 제외한 경우
-                if abs(diff)<=5:
-                    newIndx = self.list_indxCurr[i]
-                elif not np.sign(diff) == np.sign(self.list_indxCurr_diff[i]):
-                    newDAC_LSB = (intst - self.list_intst_prev[i])/self.list_indxCurr_diff[i]
-                    print(i, "---------- DAT_LSB was updated ---------\n new DAC_LSB: ", self.list_DAC_LSB[i], " ---> ", newDAC_LSB)
-                    self.list_DAC_LSB[i] = newDAC_LSB
-                    newIndx = int(self.list_indxCurr[i] - (intst - self.targetIntensity)/newDAC_LSB)
-
-            self.list_indxCurr_diff[i] = diff
-            print(i, intst, self.list_indxCurr[i], (intst - self.targetIntensity), -int((intst - self.targetIntensity)/self.list_DAC_LSB[i]), newIndx)
-            newIndxCurr.append(newIndx)
-        self._addDateIterINFO(newIndxCurr)
+        print(np.column_stack((np.arange(self.CONST_Ntube), arr_intst, arr_indxCurr, diff_target,
+                               -(diff_target/self.arr_DAC_LSB).astype(int), newIndxCurr)))
         if not self.status_CALfinished:
-            self._writeCSV(self.DirectoryLog + self.LOGfile_indxCurr, newIndxCurr)
+            self._writeCSV(self.DirectoryLog + self.LOGfile_indxCurr, self._addDateIterINFO(newIndxCurr.tolist()))
             print("original new DAC: ", newIndxCurr_original)
-            print("NEW DAC index: ", newIndxCurr[2:])
+            print("NEW DAC index: ", newIndxCurr)
         else:
-            print("!!! CAL finished !!! -- final DAC index: ", self.list_indxCurr)
-        return newIndxCurr[2:]
+            print("!!! CAL finished !!! -- final DAC index: ", arr_indxCurr)
+        return newIndxCurr.tolist()
+
+    def _updateIndxCurr(self):
+        """
+        DAC update rule of _calculateNewIndxCurr() without logging (also used by replay.py)
+        updates self.arr_DAC_LSB, self.arr_indxCurr_diff
+        :return: newIndxCurr_original (before dead band / DAC_LSB update), newIndxCurr
+        """
+        arr_intst, arr_indxCurr = self.arr_intst, self.arr_indxCurr
+        diff_target = arr_intst - self._getTarget()
+        newIndxCurr_original = (arr_indxCurr - diff_target/self.arr_DAC_LSB).astype(int)
+        diff = newIndxCurr_original - arr_indxCurr
+
+        # (n_iter == 0: newIndx 계산값 그대로 적용하는 경우)를 제외한 경우
+        has_prev = self.arr_indxCurr_diff != 0
+        hold = has_prev & (np.abs(diff) <= self.DAC_deadband)
+        # DAC step below the noise floor (deviation from target not significant): keep current DAC index
+        hold = hold | (np.abs(diff_target) <= self.confidenceZ*self._getIntensitySigma())
+        d_intst = arr_intst - self.arr_intst_prev
+        flip = has_prev & ~hold & (np.sign(diff) != np.sign(self.arr_indxCurr_diff)) & (d_intst != 0)
+
+        # tubes which failed QC: keep DAC index and the previous DAC step
+        hold = hold | self.arr_QCfail
+        diff = np.where(self.arr_QCfail, self.arr_indxCurr_diff, diff)
+        flip = flip & ~self.arr_QCfail
+
+        if self.PARTIAL:
+            # tubes within tolerance are not exposed again: keep their DAC index (first update when exposed again)
+            inTolerance = self._isInTolerance()
+            hold = hold | inTolerance
+            diff = np.where(inTolerance, 0, diff)
+            flip = flip & ~inTolerance
+
+        newIndxCurr = np.where(hold, arr_indxCurr, newIndxCurr_original)
+        if flip.any():
+            newDAC_LSB = d_intst[flip]/self.arr_indxCurr_diff[flip]
+            print(np.flatnonzero(flip), "---------- DAT_LSB was updated ---------\n new DAC_LSB: ", self.arr_DAC_LSB[flip], " ---> ", newDAC_LSB)
+            self.arr_DAC_LSB[flip] = newDAC_LSB
+            newIndxCurr[flip] = (arr_indxCurr[flip] - diff_target[flip]/newDAC_LSB).astype(int)
+
+        self.arr_indxCurr_diff = diff
+        return newIndxCurr_original, newIndxCurr
+
+    def _getIntensitySigma(self):
+        """
+        measurement noise per tube, used by the confidence test and the noise dead band:
+        sqrt(standard error in ROI^2 + (sigmaShot x intensity)^2)
+        the standard error in ROI is the pixel statistics of one frame only (< 1 count for ~10k pixels, and the field
+        gradient in ROI is part of it), the noise of repeated shots is the relative term sigmaShot
+        """
+        return np.sqrt(self.arr_intstErr**2 + (self.sigmaShot*self.arr_intst)**2)
+
+    def estimateSigmaShot(self, arr_intst_repeat):
+        """
+        sigmaShot from repeated shots at the same DAC index (n_shot x Ntube intensities, ex, rows of LOG_intst.csv)
+        median over tubes of the relative standard deviation of the shots --> self.sigmaShot
+        """
+        arr = np.asarray(arr_intst_repeat, dtype=float)
+        if arr.shape[0] < 2: raise Exception("E07: at least 2 shots are needed to estimate sigmaShot")
+        self.sigmaShot = float(np.median(arr.std(axis=0, ddof=1)/arr.mean(axis=0)))
+        print("---- sigmaShot (relative shot-to-shot reproducibility): ", self.sigmaShot)
+        return self.sigmaShot
+
+    def _isInTolerance(self):
+        """
+        bool array: intensity of each tube is within targetIntensity +/- limitVariation
+        confidence test: a tube is in tolerance only if it is significantly inside the band, i.e.
+        |deviation| + confidenceZ x measurement noise <= band (the +/- limitVariation spec holds at the confidence level,
+        the error bars of _showHistVariance())
+        """
+        arr_target = self._getTarget()
+        band = arr_target*self.limitVariation
+        inTolerance = np.abs(arr_target - self.arr_intst) + self.confidenceZ*self._getIntensitySigma() <= band
+        return inTolerance & ~self.arr_QCfail   # tubes which failed QC have to be exposed again
 
     def _calculateVariance(self):
-        for intst in self.list_intst:
-            if abs(self.targetIntensity - intst)>self.targetIntensity*self.limitVariation: return False
-        return True
+        return bool(np.all(self._isInTolerance()))
 
     def _showHistVariance(self, list_newDAC):
-        x, y = np.arange(self.CONST_Ntube), self.list_intst
+        x, y = np.arange(self.CONST_Ntube), self.arr_intst
         id = ['Tube_{num}'.format(num = n) for n in range(self.CONST_Ntube)]
         xmin, xmax = -0.8, self.CONST_Ntube - 0.2
         ymin, ymax = self.targetIntensity*(1 - self.limitVariation), self.targetIntensity*(1 + self.limitVariation)
@@ -322,61 +757,82 @@ class TVC():
         path_outputPNG = self.Directory + "/Histo_TubeIntensity_iter{n}.png".format(n=self.n_iter)
         plt.subplots(figsize=(10, 8))
         plt.fill([xmin, xmin, xmax, xmax], [ymin, ymax, ymax, ymin], color='lightgray', alpha=0.5)
-        plt.bar(x, y)
+        plt.bar(x, y, yerr=self.confidenceZ*self._getIntensitySigma())     # in tolerance: error bar inside the band
         plt.hlines(ymax, xmin=xmin, xmax=xmax, colors='r', linestyles='dashdot')
         plt.hlines(self.targetIntensity, xmin=xmin, xmax=xmax, colors='r', linestyles='solid')
+        if np.any(self.arr_targetFactor != 1): plt.plot(x, self._getTarget(), 'k_', markersize=30)     # target per tube
         plt.hlines(ymin, xmin=xmin, xmax=xmax, colors='r', linestyles='dashdot')
         plt.xlim(xmin, xmax)
         plt.xticks(x, id)
         plt.ylabel('X-ray image intensity')
         if self.status_CALfinished:
             plt.title("Variation of X-ray tube output at iter#_{num}\n {DAC_old} --> FINAL DAC index".format(num=self.n_iter,
-                                                                                                DAC_old=self.list_indxCurr))
+                                                                                                DAC_old=self.arr_indxCurr.tolist()))
         else:
             plt.title("Variation of X-ray tube output at iter#_{num}\n {DAC_old} --> {DAC_new}".format(num=self.n_iter,
-                                                                                                   DAC_old=self.list_indxCurr,
+                                                                                                   DAC_old=self.arr_indxCurr.tolist(),
                                                                                                    DAC_new=list_newDAC))
         plt.savefig(path_outputPNG)
         plt.show()
 
     def checkUniformity(self, directory, MODE_rename):
-        self._calculateTubeCenter()
+        """
+        ROI intensity of every step x tube frame in directory (Ntube files per step)
+        MODE_rename: files 0.raw, 1.raw, ... in the order of tube Ntube-1 ... 0, else: os.listdir() order of tube 0 ... Ntube-1
+        :return: step x tube matrices of intensity and its error, columns in tube index order
+                 (NaN: missing file or no intensity in ROI), error: standard error in ROI (PREVIEW: bound of the sampling)
+        """
         fileList = os.listdir(directory)
-        list_intst = []
-
-        if MODE_rename:
-            for i in range(len(fileList)):
-                iLine, iTube = i // self.CONST_Ntube, 6-(i % self.CONST_Ntube)
-                PosLine = int(iLine * self.CONST_SizeStep)  # [mm]
-                self.setPosLine(PosLine)
-                fname = str(i) + ".raw"
-                data2D = self._readData(directory + fname)
-
-                iIntst, x_min, x_max, y_min, y_max = self._getIntensity(iTube, data2D)
-                #if self.DEBUG: self._showImage_rect(data2D, x_min, x_max, y_min, y_max)
-                if iIntst>0:
-                    list_intst.append(iIntst)
-                print(i, iLine, iTube, " PosLine: ", PosLine, " -- iIntst: ", iIntst)
-
-        else:
-            for i, f in enumerate(fileList):
-                iLine, iTube = i//self.CONST_Ntube, i%self.CONST_Ntube
-                PosLine = int(iLine*self.CONST_SizeStep) # [mm]
-                self.setPosLine(PosLine)
-                data2D = self._readData(directory + f)
-
-                iIntst, x_min, x_max, y_min, y_max = self._getIntensity(iTube, data2D)
-                if self.DEBUG: self._showImage_rect(data2D, x_min, x_max, y_min, y_max)
-                list_intst.append(iIntst)
-                print(i, iLine, iTube, " PosLine: ", PosLine, " -- iIntst: ", iIntst)
-
+        nStep = -(-len(fileList) // self.CONST_Ntube)
+        arr_intst = np.full((nStep, self.CONST_Ntube), np.nan)
+        arr_intstErr = np.full((nStep, self.CONST_Ntube), np.nan)
+
+        for i, f in enumerate(fileList):
+            iLine, iTube = i // self.CONST_Ntube, i % self.CONST_Ntube
+            if MODE_rename:
+                iTube, f = (self.CONST_Ntube - 1) - iTube, str(i) + ".raw"
+            PosLine = int(iLine*self.CONST_SizeStep) # [mm]
+            self.setPosLine(PosLine)
+            (iIntst, iErr, x_min, x_max, y_min, y_max), data2D = self._getIntensityFile(iTube, directory + f)
+            if self.DEBUG and data2D is not None: self._showImage_rect(data2D, x_min, x_max, y_min, y_max)
+            if iIntst>0:
+                arr_intst[iLine, iTube], arr_intstErr[iLine, iTube] = iIntst, iErr
+            print(i, iLine, iTube, " PosLine: ", PosLine, " -- iIntst: ", iIntst, " +/- ", iErr)
+
+        if self.uniformityCache is not None: self.uniformityCache.save()
+        if self.PREVIEW: print("PREVIEW (stride {s}) -- max. error of ROI intensity: ".format(s=self.previewStride), np.nanmax(arr_intstErr))
+        self._showImage(arr_intst, tit="Uniformity Check", xl='tube Number', yl= 'Step Number')
+        return arr_intst, arr_intstErr   # step x tube
+
+    def setRecorder(self, recorder):
+        """record every run() (input frames, DAC, intensities, new DAC) -- regression.SessionRecorder, None: off"""
+        self.recorder = recorder
+
+    def setUniformityCache(self, file_path, maxEntries=100000):
+        """
+        persistent cache of ROI intensities for checkUniformity() (file_path None: no cache)
+        key: (path, size, mtime, geometry, tube, line position, LOCALIZE) --> only new or changed frames are processed
+        """
+        self.uniformityCache = None if file_path is None else ResultCache(file_path, maxEntries)
 
-        m = int(len(fileList)//self.CONST_Ntube)
-        if len(fileList) == self.CONST_Ntube*m :
-            list_intst = np.asarray(list_intst)
-            list_intst = np.reshape(list_intst, (-1, self.CONST_Ntube))
-            list_intst = np.fliplr(list_intst)
-            self._showImage(list_intst, tit="Uniformity Check", xl='tube Number', yl= 'Step Number')
+    def _getIntensityFile(self, iTube, file_path):
+        """
+        _getIntensity() of a data file, from self.uniformityCache if possible
+        :return: (iI, iErr, i_min, i_max, j_min, j_max), data2D (None: result from the cache)
+        """
+        stride = self.previewStride if self.PREVIEW else 1
+        readData = self._readDataPreview if self.PREVIEW else self._readData
+        if self.uniformityCache is None:
+            data2D = readData(file_path)
+            return self._getIntensity(iTube, data2D, stride), data2D
+
+        key = ResultCache.fileKey(file_path, [self.geometry, int(iTube), self.c_tibes, self.LOCALIZE, stride])
+        result = self.uniformityCache.get(key)
+        if result is not None: return tuple(result), None
+        data2D = readData(file_path)
+        result = self._getIntensity(iTube, data2D, stride)
+        self.uniformityCache.put(key, [float(result[0]), float(result[1])] + [int(v) for v in result[2:]])
+        return result, data2D
 
     def getDACLinearity(self):
         directory = "D:/Data/Calibration_tube/DAC/"
@@ -389,7 +845,7 @@ class TVC():
         for dac in range(DAC_min, DAC_max+1, DAC_interval):
             DirectoryDAC = directory + folderNames[i] + '/'
             print(dac, DirectoryDAC)
-            self.list_intst = self._getListIntensity(DirectoryDAC)
+            self.arr_intst = self._getListIntensity(DirectoryDAC)
             i+=1
 
     def _overWriteCSV(self, fileName, list_result):
@@ -416,14 +872,22 @@ class TVC():
         self.n_iter = n_iter
         self.ArchiveON = True
         self.status_running = True
-        self.list_intst = self._getListIntensity(self.DirectoryCAL)
-        if int(n_iter) == 0: self._calculateNewTarget(self.list_intst)
+        self.arr_intst = self._getListIntensity(self.DirectoryCAL)
+        self._writeCSV(self.DirectoryLog + self.LOGfile_indxCurr, self._addDateIterINFO(self.arr_indxCurr.tolist()))
+        if int(n_iter) == 0: self._calculateNewTarget(self.arr_intst)
         self.status_CALfinished = self._calculateVariance()
+        self._writeCSV(self.DirectoryLog + self.LOGfile_finished,
+                       [date.today().strftime("%Y-%m-%d"), self.n_iter, int(self.status_CALfinished)])
         print("status_CALfinished: ", self.status_CALfinished)
-        print("--- list of intensity: ", self.list_intst, '\n--- list of new DAC index for TubeCurr.: ', self.list_indxCurr)
+        print("--- list of intensity: ", self.arr_intst, '\n--- list of new DAC index for TubeCurr.: ', self.arr_indxCurr)
         list_newIndxCurr = self._calculateNewIndxCurr()
+        if self.recorder is not None: self.recorder.record(self, list_newIndxCurr)
         self.status_running = False
-        self.list_intst_prev = [self.list_intst[i] for i in range(self.CONST_Ntube)]
+        self.arr_intst_prev = self.arr_intst.copy()
+        self.arr_intstErr_prev = self.arr_intstErr.copy()
+        if self.PARTIAL and not self.status_CALfinished: self._setExposeTube(~self._isInTolerance())
+        else: self._setExposeTube(np.ones(self.CONST_Ntube, dtype=bool))
+        print("--- tubes to be exposed in the next acquisition: ", self.getExposeTube())
         self._showHistVariance(list_newIndxCurr)
         return list_newIndxCurr
 
@@ -432,9 +896,8 @@ if __name__ == "__main__":
     #input variables
     LinePosition, tubeVolt, tubeCurr = 150.0, 60, 0.5
     cnt_iter = 0
-    list_indxCurr = [0, 0, 0, 0, 0, 0, 0]
-
     tvc = TVC()
+    list_indxCurr = [0]*tvc.CONST_Ntube
 
     tvc.setPathCALdirectory('D:/Data/Calibration_tube')  # generate cal, archive, log directories
     tvc.setPosLine(LinePosition)
@@ -447,5 +910,6 @@ if __name__ == "__main__":
         print("list_indxDAC: ", list_indxCurr)
         tvc.setCurrentIndex(list_indxCurr)
         list_newDACindx = tvc.run(cnt_iter)  # get new DAC index
+        # (GUI) --> expose only tvc.getExposeTube() in the next acquisition (all tubes if PARTIAL is off)
         if not tvc.isCALfinished(): tvc.saveDACindex(list_newDACindx)
         cnt_iter+=1
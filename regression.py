@@ -0,0 +1,307 @@
+###########################################
+# Recorded-session regression harness
+# - SessionRecorder: captures every TVC.run() (input frames, DAC index, intensities, new DAC index)
+# - makeSyntheticSession(): synthetic session recorded through TVC.run() (stand-in frames, closed loop)
+# - replaySession(): replays a session through several code paths (baseline algorithms, current TVC)
+#   and compares intensities / new DAC index within tolerances, with timing side by side
+###########################################
+import os
+import io
+import json
+import shutil
+import struct
+import contextlib
+from time import perf_counter
+import numpy as np
+import matplotlib.pyplot as plt
+from main import TVC
+from framering import StandInProducer
+
+SESSION_FILE = 'session.json'
+# TVC parameters which are recorded with a session
+PARAM_KEYS = ('limitVariation', 'DAC_deadband', 'DAC_LSB_default', 'targetRule', 'minValidTubes', 'confidenceZ', 'sigmaShot',
+              'LOCALIZE', 'PARTIAL', 'QCmode', 'targetIntensity')
+
+
+class SessionRecorder():
+    """
+    TVC.setRecorder(SessionRecorder(directory)): input frames are copied to directory, the rest goes to session.json
+    (frames from a frame ring are not captured, record sessions from the CAL directory)
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory): os.mkdir(directory)
+        self.session = None
+
+    def record(self, tvc, list_newIndxCurr):
+        if self.session is None:
+            self.session = {'geometry': tvc.geometry,
+                            'params': {key: _toJSON(getattr(tvc, key)) for key in PARAM_KEYS},
+                            'iterations': []}
+        list_frame = []
+        for path in tvc.list_framePath:
+            fname = "itr{n}_{f}".format(n=len(self.session['iterations']), f=os.path.basename(path))
+            shutil.copy(path, os.path.join(self.directory, fname))
+            list_frame.append(fname)
+        self.session['iterations'].append({
+            'n_iter': int(tvc.n_iter),
+            'c_tibes': int(tvc.c_tibes),
+            'exposeTube': tvc.getExposeTube(),
+            'indxCurr': tvc.arr_indxCurr.tolist(),
+            'intst': tvc.arr_intst.tolist(),
+            'target': float(tvc.targetIntensity),
+            'targetFactor': tvc.arr_targetFactor.tolist(),
+            'QCfail': tvc.arr_QCfail.tolist(),
+            'finished': bool(tvc.status_CALfinished),
+            'newIndxCurr': [int(v) for v in list_newIndxCurr],
+            'frames': list_frame})
+        self.save()
+
+    def save(self):
+        with open(os.path.join(self.directory, SESSION_FILE), 'w') as fd:
+            json.dump(self.session, fd, indent=1)
+
+
+def _toJSON(val):
+    return val.item() if isinstance(val, np.generic) else val
+
+
+def loadSession(directory):
+    with open(os.path.join(directory, SESSION_FILE), 'r') as fd:
+        session = json.load(fd)
+    session['directory'] = directory
+    return session
+
+
+class LegacyPath():
+    """baseline algorithms of TVC: struct reader, int ROI mean, per tube DAC loop with a fixed dead band"""
+    name = 'legacy'
+    compareReference, compareRecorded = False, False
+
+    def __init__(self, session):
+        g, params = session['geometry'], session['params']
+        self.Npixel_x, self.Npixel_y, self.ActiveArea_x_max = g['Npixel_x'], g['Npixel_y'], g['ActiveArea_x_max']
+        self.HalfROI, Ntube = g['HalfROI'], g['Ntube']
+        pitch_idx = g['PitchTube']/g['SizePixel']
+        indx_s = int(int(self.Npixel_y / 2) - int(Ntube / 2) * pitch_idx - 0.5 * pitch_idx * (Ntube % 2 - 1))
+        self.r_tubes = [int(indx_s + i*pitch_idx) for i in range(Ntube)]
+        self.limitVariation = params['limitVariation']
+        self.targetIntensity = params['targetIntensity']
+        self.list_DAC_LSB = [params['DAC_LSB_default']]*Ntube
+        self.list_indxCurr_diff = [0]*Ntube
+        self.list_intst_prev = [0]*Ntube
+
+    def setPosition(self, c_tibes):
+        self.c_tibes = c_tibes
+
+    def readData(self, file_path):
+        with open(file_path, 'rb') as input_file:
+            fileContent = input_file.read()
+            data_1D = np.asarray(struct.unpack("H" * (len(fileContent) // 2), fileContent))
+        return np.reshape(data_1D, (self.Npixel_y, self.Npixel_x))
+
+    def getIntensity(self, iTube, data2D):
+        hw = self.HalfROI
+        i_min, i_max = int(max(0, self.r_tubes[iTube] - hw)), int(min(self.r_tubes[iTube] + hw, self.Npixel_y))
+        j_min, j_max = int(max(0, self.c_tibes - hw)), int(min(self.c_tibes + hw, self.ActiveArea_x_max))
+        if j_max < j_min: j_min = j_max
+        dataROI = data2D[i_min:i_max, j_min:j_max]
+        dataROI = dataROI[~np.isnan(dataROI)]
+        dataROI = dataROI[dataROI > 0]
+        return (int(np.mean(dataROI)) if len(dataROI) > 0 else 0), 0.0
+
+    def step(self, it, list_intst, list_intstErr):
+        n_iter, list_indxCurr = it['n_iter'], it['indxCurr']
+        if n_iter == 0:
+            list_intensity = sorted(list_intst)
+            self.targetIntensity = int(sum(list_intensity[1:-1])/len(list_intensity[1:-1]))
+        finished = all(abs(self.targetIntensity - intst) <= self.targetIntensity*self.limitVariation for intst in list_intst)
+        newIndxCurr = []
+        for i, intst in enumerate(list_intst):
+            newIndx = int(list_indxCurr[i] - (intst - self.targetIntensity)/self.list_DAC_LSB[i])
+            diff = newIndx - list_indxCurr[i]
+            if not self.list_indxCurr_diff[i] == 0:
+                if abs(diff) <= 5:
+                    newIndx = list_indxCurr[i]
+                elif not np.sign(diff) == np.sign(self.list_indxCurr_diff[i]):
+                    newDAC_LSB = (intst - self.list_intst_prev[i])/self.list_indxCurr_diff[i]
+                    self.list_DAC_LSB[i] = newDAC_LSB
+                    newIndx = int(list_indxCurr[i] - (intst - self.targetIntensity)/newDAC_LSB)
+            self.list_indxCurr_diff[i] = diff
+            newIndxCurr.append(newIndx)
+        self.list_intst_prev = list(list_intst)
+        return newIndxCurr, finished
+
+
+class TVCPath():
+    """current TVC code (_readData, _getIntensity, _updateIndxCurr)"""
+    def __init__(self, session, legacy=False):
+        """legacy: parameters equivalent to the baseline algorithms (compared with LegacyPath)"""
+        self.name = 'tvc-legacy' if legacy else 'tvc'
+        self.legacy = legacy
+        self.compareReference, self.compareRecorded = legacy, not legacy
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.tvc = TVC(session['geometry'])
+        for key, val in session['params'].items(): setattr(self.tvc, key, val)
+        if legacy:
+            self.tvc.confidenceZ, self.tvc.sigmaShot, self.tvc.DAC_deadband = 0.0, 0.0, 5
+            self.tvc.targetRule, self.tvc.LOCALIZE, self.tvc.PARTIAL, self.tvc.QCmode = 'trimmed_mean', False, False, None
+        self.tvc.arr_DAC_LSB = np.full(self.tvc.CONST_Ntube, self.tvc.DAC_LSB_default, dtype=float)
+
+    def setPosition(self, c_tibes):
+        self.tvc.c_tibes = c_tibes
+
+    def readData(self, file_path):
+        return self.tvc._readData(file_path)
+
+    def getIntensity(self, iTube, data2D):
+        return self.tvc._getIntensity(iTube, data2D)[:2]
+
+    def step(self, it, list_intst, list_intstErr):
+        tvc = self.tvc
+        tvc.n_iter = n_iter = it['n_iter']
+        tvc.arr_indxCurr = np.asarray(it['indxCurr'], dtype=int)
+        tvc.arr_intst = np.asarray(list_intst, dtype=float)
+        tvc.arr_intstErr = np.asarray(list_intstErr, dtype=float)
+        if not self.legacy:     # per tube target and QC result of the recorded run
+            if 'targetFactor' in it: tvc.arr_targetFactor = np.asarray(it['targetFactor'], dtype=float)
+            if 'QCfail' in it: tvc.arr_QCfail = np.asarray(it['QCfail'], dtype=bool)
+        if n_iter == 0: tvc._calculateNewTarget(tvc.arr_intst)
+        finished = tvc._calculateVariance()
+        newIndxCurr_original, newIndxCurr = tvc._updateIndxCurr()
+        tvc.arr_intst_prev = tvc.arr_intst.copy()
+        return newIndxCurr.tolist(), finished
+
+
+def _runPath(path, session):
+    """one code path over all iterations --> intensities, new DAC index, finished, timing [s] (read, intensity, DAC)"""
+    Ntube = session['geometry']['Ntube']
+    list_intst, list_newIndx, list_finished = [], [], []
+    timing = np.zeros(3)
+    arr_intst, arr_intstErr = np.zeros(Ntube), np.zeros(Ntube)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for it in session['iterations']:
+            path.setPosition(it['c_tibes'])
+            for iTube, fname in zip(it['exposeTube'], it['frames']):
+                if it.get('QCfail', [False]*Ntube)[iTube]: continue  # failed QC: last intensity is kept (as in run())
+                t0 = perf_counter()
+                data2D = path.readData(os.path.join(session['directory'], fname))
+                t1 = perf_counter()
+                arr_intst[iTube], arr_intstErr[iTube] = path.getIntensity(iTube, data2D)
+                timing += [t1 - t0, perf_counter() - t1, 0]
+            t0 = perf_counter()
+            newIndx, finished = path.step(it, arr_intst.tolist(), arr_intstErr.tolist())
+            timing[2] += perf_counter() - t0
+            list_intst.append(arr_intst.copy())
+            list_newIndx.append(newIndx)
+            list_finished.append(finished)
+    return {'intst': np.asarray(list_intst), 'newIndxCurr': np.asarray(list_newIndx), 'finished': list_finished,
+            'timing': timing}
+
+
+def _compare(name, result, intst, newIndxCurr, finished, atol_intst, atol_DAC):
+    dIntst = np.abs(result['intst'] - intst).max(axis=1)
+    dDAC = np.abs(result['newIndxCurr'] - newIndxCurr).max(axis=1)
+    failures = ["{name} iter#{n}: |d intensity| {dI:.2f} > {tol}".format(name=name, n=n, dI=d, tol=atol_intst)
+                for n, d in enumerate(dIntst) if d > atol_intst]
+    failures += ["{name} iter#{n}: |d DAC| {dD} > {tol}".format(name=name, n=n, dD=d, tol=atol_DAC)
+                 for n, d in enumerate(dDAC) if d > atol_DAC]
+    failures += ["{name} iter#{n}: finished {a} != {b}".format(name=name, n=n, a=a, b=b)
+                 for n, (a, b) in enumerate(zip(result['finished'], finished)) if a != b]
+    return dIntst, dDAC, failures
+
+
+def replaySession(directory, paths=None, atol_intst=1.0, atol_DAC=1):
+    """
+    replay a recorded session through code paths and compare
+    paths: list of path objects, the first one is the reference (default: LegacyPath, TVCPath(legacy), TVCPath)
+    - path.compareReference: intensities / new DAC index / finished vs. the reference path
+    - path.compareRecorded : the same vs. the values recorded in the session
+    atol_intst: intensity tolerance (1.0: int truncation of the baseline ROI mean), atol_DAC: DAC index tolerance
+    :return: report dict(paths, timing, failures)
+    """
+    session = loadSession(directory)
+    Ntube = session['geometry']['Ntube']
+    # baseline algorithms expose all tubes, have one target and no QC
+    legacyOK = all(len(it['exposeTube']) == Ntube and not any(it.get('QCfail', [])) and
+                   all(f == 1 for f in it.get('targetFactor', [])) for it in session['iterations'])
+    if paths is None:
+        paths = [LegacyPath(session), TVCPath(session, legacy=True), TVCPath(session)]
+        if not legacyOK:
+            print("PARTIAL / QC / target factor session: baseline paths are skipped")
+            paths = paths[2:]
+
+    results = [_runPath(path, session) for path in paths]
+    recorded = {key: np.asarray([it[key] for it in session['iterations']]) for key in ('intst', 'newIndxCurr')}
+    recorded['finished'] = [it['finished'] for it in session['iterations']]
+
+    failures = []
+    print("path, read [s], intensity [s], DAC [s], max |d intensity|, max |d DAC|  (vs. reference / recorded)")
+    for path, result in zip(paths, results):
+        dI, dD = [], []
+        if path.compareReference and path is not paths[0]:
+            dIntst, dDAC, fail = _compare(path.name + ' vs ' + paths[0].name, result, results[0]['intst'],
+                                          results[0]['newIndxCurr'], results[0]['finished'], atol_intst, atol_DAC)
+            dI.append(dIntst.max()), dD.append(dDAC.max())
+            failures += fail
+        if path.compareRecorded:
+            dIntst, dDAC, fail = _compare(path.name + ' vs recorded', result, recorded['intst'],
+                                          recorded['newIndxCurr'], recorded['finished'], atol_intst, atol_DAC)
+            dI.append(dIntst.max()), dD.append(dDAC.max())
+            failures += fail
+        print(path.name, np.round(result['timing'], 4), np.round(dI, 2), dD)
+
+    for failure in failures: print("!!! ", failure)
+    return {'paths': [path.name for path in paths], 'timing': [result['timing'] for result in results],
+            'failures': failures}
+
+
+def assertSession(directory, paths=None, atol_intst=1.0, atol_DAC=1):
+    report = replaySession(directory, paths, atol_intst, atol_DAC)
+    assert not report['failures'], "\n".join(report['failures'])
+    return report
+
+
+def makeSyntheticSession(directory, geometry=None, nIter=4, PosLine=150.0, noise=30.0, seed=0, QCmode='flag', PARTIAL=False):
+    """
+    synthetic session recorded through TVC.run() (capture path: recorder hook, _getListIntensity, QC, PARTIAL)
+    flat frames per exposed tube with intensity = base + DAC_LSB x DAC index (+ pixel noise) are written to the
+    CAL directory by framering.StandInProducer, the DAC index of the next iteration is the one returned by run()
+    (histograms of run() are drawn with the Agg backend, the work directory is removed at the end)
+    """
+    plt.switch_backend('Agg')
+    rng = np.random.default_rng(seed)
+    recorder = SessionRecorder(directory)
+    dirWork = os.path.join(directory, 'work')
+    if not os.path.exists(dirWork): os.mkdir(dirWork)
+    with contextlib.redirect_stdout(io.StringIO()):
+        tvc = TVC(geometry)
+        tvc.setQCmode(QCmode)
+        tvc.PARTIAL = PARTIAL
+        tvc.setPathCALdirectory(dirWork)
+        tvc.setPosLine(PosLine)
+        tvc.setRecorder(recorder)
+    producer = StandInProducer(directory=tvc.DirectoryCAL)
+    Ntube, shape = tvc.CONST_Ntube, (tvc.CONST_Npixel_y, tvc.CONST_Npixel_x)
+    base = tvc.targetIntensity*(1 + 0.05*rng.standard_normal(Ntube))
+    slope = tvc.DAC_LSB_default*(1 + 0.1*rng.standard_normal(Ntube))
+
+    list_indxCurr = [0]*Ntube
+    for n_iter in range(nIter):
+        list_tube = tvc.getExposeTube()
+        list_frame = [np.clip(base[i] + slope[i]*list_indxCurr[i] + noise*rng.standard_normal(shape), 1, 65535).astype(np.uint16)
+                      for i in list_tube]
+        producer.pushAcquisition(list_frame, list_tube, tvc.CONST_Ndummy, n_iter=n_iter)
+        with contextlib.redirect_stdout(io.StringIO()):
+            tvc.setCurrentIndex(list(list_indxCurr))
+            list_newIndxCurr = tvc.run(n_iter)
+        plt.close('all')
+        if not tvc.isCALfinished(): list_indxCurr = list_newIndxCurr
+    shutil.rmtree(dirWork)
+    return directory
+
+
+if __name__ == "__main__":
+
+    directory = makeSyntheticSession('./regression_synthetic')
+    assertSession(directory)
@@ -0,0 +1,272 @@
+###########################################
+# Offline replay of archived TVC calibration sessions
+# - rebuild sessions from log/LOG_intst.csv, log/LOG_indxCurr.csv (and archive/ frames)
+# - fit a linear intensity-vs-DAC response per tube
+# - re-run the TVC DAC loop with alternate parameters (what-if) in a process pool
+# - report iterations-to-converge and final spread per configuration
+###########################################
+import os
+import io
+import csv
+import contextlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from main import TVC
+
+# parameters of a replay configuration (missing keys: the values of TVC())
+CONFIG_KEYS = ('geometry', 'limitVariation', 'DAC_deadband', 'DAC_LSB_default', 'targetRule', 'LOCALIZE', 'PARTIAL',
+               'confidenceZ', 'sigmaShot')
+
+
+def readLogCSV(file_path):
+    """rows of a TVC log (date, n_iter, value per tube) --> list of (n_iter, np.array of values)"""
+    rows = []
+    if not os.path.exists(file_path): return rows
+    with open(file_path, 'r') as fd:
+        for row in csv.reader(fd):
+            if len(row) < 3: continue
+            rows.append((int(row[1]), np.asarray([float(v) for v in row[2:]])))
+    return rows
+
+
+def loadSessions(directory):
+    """
+    rebuild calibration sessions of a CAL directory (the path given to TVC.setPathCALdirectory())
+    LOG_intst.csv: one row per run(), a session starts at n_iter == 0
+    LOG_indxCurr.csv: per run() the applied DAC (setCurrentIndex, logged once the acquisition was read) and,
+                      if CAL was not finished, the new DAC
+    LOG_finished.csv: per run() CAL finished or not (--> whether a new DAC row follows the applied DAC)
+    LOG_exposeTube.csv: per run() exposed tubes (PARTIAL), all tubes if the log does not cover all runs
+    logs without LOG_finished.csv: the new DAC row and the next setCurrentIndex row have the same
+    (n_iter, DAC index), the duplicates are dropped
+    :return: list of dict(directory, intst (n_iter x Ntube), indxCurr (n_iter x Ntube), exposeTube (n_iter x Ntube, bool),
+                          n_iter_finished (iterations to the first finished run, -1: not finished, None: no LOG_finished.csv))
+    """
+    rows_intst = readLogCSV(os.path.join(directory, 'log', 'LOG_intst.csv'))
+    rows_indx = readLogCSV(os.path.join(directory, 'log', 'LOG_indxCurr.csv'))
+    rows_finished = readLogCSV(os.path.join(directory, 'log', 'LOG_finished.csv'))
+    rows_expose = readLogCSV(os.path.join(directory, 'log', 'LOG_exposeTube.csv'))
+    if len(rows_expose) != len(rows_intst):
+        rows_expose = [(n_iter, np.ones(len(intst))) for n_iter, intst in rows_intst]
+
+    hasFinished = len(rows_finished) == len(rows_intst)
+    if hasFinished:
+        list_newDAC = [not bool(values[0]) for n_iter, values in rows_finished]
+    else:
+        print("{dir}: LOG_finished.csv does not cover all runs --> duplicated DAC rows are dropped".format(dir=directory))
+        rows_indx = [row for k, row in enumerate(rows_indx)
+                     if k == 0 or row[0] != rows_indx[k - 1][0] or np.any(row[1] != rows_indx[k - 1][1])]
+        list_newDAC = [False]*len(rows_intst)
+
+    sessions = []
+    i_row = 0
+    for (n_iter, intst), newDAC, (n, expose) in zip(rows_intst, list_newDAC, rows_expose):
+        if n_iter == 0 or not sessions:
+            sessions.append({'directory': directory, 'intst': [], 'indxCurr': [], 'exposeTube': [],
+                             'n_iter_finished': -1 if hasFinished else None})
+        if i_row >= len(rows_indx):
+            raise Exception("E10: LOG_indxCurr.csv has less rows than LOG_intst.csv in {dir}".format(dir=directory))
+        sessions[-1]['intst'].append(intst)
+        sessions[-1]['indxCurr'].append(rows_indx[i_row][1])
+        sessions[-1]['exposeTube'].append(expose > 0)
+        if hasFinished and not newDAC and sessions[-1]['n_iter_finished'] < 0:     # runs after convergence are not counted
+            sessions[-1]['n_iter_finished'] = len(sessions[-1]['intst'])
+        i_row += 2 if newDAC else 1
+    for session in sessions:
+        session['intst'] = np.asarray(session['intst'])
+        session['indxCurr'] = np.asarray(session['indxCurr'], dtype=int)
+        session['exposeTube'] = np.asarray(session['exposeTube'], dtype=bool)
+    return sessions
+
+
+def listArchiveBlocks(tvc, directory, list_exposeTube, sortBy='name'):
+    """
+    archived files of a CAL directory grouped per acquisition (Ndummy dummy + (shot + dummy) X exposed tubes)
+    list_exposeTube: exposed tubes (bool array of size Ntube) of every logged acquisition, in order
+    sortBy: 'name' (order of os.listdir() on the acquisition PC) or 'mtime' (acquisition time)
+    :return: list of (iTube, data file path) per acquisition, None if the archived files do not match the acquisitions
+    """
+    dirArchive = os.path.join(directory, 'archive')
+    if not os.path.isdir(dirArchive): return None
+    paths = [os.path.join(dirArchive, f) for f in os.listdir(dirArchive)]
+    if sortBy == 'mtime': paths.sort(key=os.path.getmtime)
+    else: paths.sort()
+    if len(paths) != sum(tvc.CONST_Ndummy + 2*int(np.sum(expose)) for expose in list_exposeTube): return None
+
+    blocks, i_start = [], 0
+    for expose in list_exposeTube:
+        list_tube = np.flatnonzero(expose)
+        blocks.append([(int(iTube), paths[i_start + tvc.CONST_Ndummy + 2*k]) for k, iTube in enumerate(list_tube)])
+        i_start += tvc.CONST_Ndummy + 2*len(list_tube)
+    return blocks
+
+
+def extractIntensity(tvc, block, PosLine, arr_intst_prev):
+    """
+    re-run the intensity extraction of TVC on the archived data files of one acquisition (listArchiveBlocks())
+    tubes which were not exposed keep their intensity of the previous acquisition (arr_intst_prev)
+    """
+    tvc.setPosLine(PosLine)
+    arr_intst = np.array(arr_intst_prev, dtype=float)
+    for iTube, path in block:
+        arr_intst[iTube] = tvc._getIntensity(iTube, tvc._readData(path))[0]
+    return arr_intst
+
+
+def fitResponse(arr_indxCurr, arr_intst, DAC_LSB_default, arr_exposeTube=None, minSpan=10):
+    """
+    per tube linear response: intensity = offset + slope*DAC (least squares over iterations)
+    slope = DAC_LSB_default if the fitted DAC span is < minSpan DAC index (slope dominated by noise) or slope <= 0
+    arr_exposeTube: only exposed iterations of a tube are fitted (PARTIAL, kept intensities are no measurement)
+    nan intensities (failed QC) are not fitted
+    :return: offset, slope, sigma (rms residual) -- arrays of size Ntube
+    """
+    x, y = np.asarray(arr_indxCurr, dtype=float), np.asarray(arr_intst, dtype=float)
+    w = np.ones_like(x) if arr_exposeTube is None else np.asarray(arr_exposeTube, dtype=float)
+    w = w*np.isfinite(y)
+    y = np.where(w > 0, y, 0.0)
+    n = np.maximum(w.sum(axis=0), 1)
+    x_mean, y_mean = (w*x).sum(axis=0)/n, (w*y).sum(axis=0)/n
+    sxx = (w*(x - x_mean)**2).sum(axis=0)
+    sxy = (w*(x - x_mean)*(y - y_mean)).sum(axis=0)
+    slope = np.full(x.shape[1], float(DAC_LSB_default))
+    x_span = np.where(w > 0, x, np.nan)
+    span = np.nan_to_num(np.nanmax(x_span, axis=0) - np.nanmin(x_span, axis=0))
+    fitted = (sxx > 0) & (span >= minSpan)
+    slope[fitted] = sxy[fitted]/sxx[fitted]
+    slope[slope <= 0] = float(DAC_LSB_default)
+    offset = y_mean - slope*x_mean
+    residual = y - (offset + slope*x)
+    dof = np.maximum(n - 2, 1)
+    sigma = np.sqrt((w*residual**2).sum(axis=0)/dof)
+    return offset, slope, sigma
+
+
+def simulateCAL(tvc, offset, slope, sigma, indxCurr_start, maxIter=10, seed=0):
+    """
+    closed-loop TVC iterations on the fitted response (no exposure, no files)
+    PARTIAL: only tubes out of tolerance are exposed again, the others keep their last intensity
+    :return: dict(n_iter (iterations to converge, -1: not converged), n_shot (# of tube exposures), finished, target,
+                  spread, maxDev, indxCurr, intst)
+    """
+    rng = np.random.default_rng(seed)
+    tvc.initVariables()
+    tvc.arr_DAC_LSB = np.full(tvc.CONST_Ntube, tvc.DAC_LSB_default, dtype=float)
+    tvc.arr_indxCurr = np.asarray(indxCurr_start, dtype=int)
+    n_shot = 0
+    for n_iter in range(maxIter):
+        tvc.n_iter = n_iter
+        arr_model = offset + slope*tvc.arr_indxCurr + sigma*rng.standard_normal(tvc.CONST_Ntube)
+        tvc.arr_intst = np.where(tvc.arr_exposeTube, arr_model, tvc.arr_intst_prev)
+        tvc.arr_intstErr = sigma
+        n_shot += int(tvc.arr_exposeTube.sum())
+        if n_iter == 0: tvc._calculateNewTarget(tvc.arr_intst)
+        tvc.status_CALfinished = tvc._calculateVariance()
+        if tvc.status_CALfinished: break
+        newIndxCurr_original, newIndxCurr = tvc._updateIndxCurr()
+        tvc.arr_intst_prev = tvc.arr_intst.copy()
+        tvc.arr_indxCurr = newIndxCurr
+        if tvc.PARTIAL: tvc._setExposeTube(~tvc._isInTolerance())
+
+    target = float(tvc.targetIntensity)
+    return {'n_iter': n_iter + 1 if tvc.status_CALfinished else -1,
+            'n_shot': n_shot,
+            'finished': tvc.status_CALfinished,
+            'target': target,
+            'spread': float(np.ptp(tvc.arr_intst)/target),
+            'maxDev': float(np.max(np.abs(tvc.arr_intst - target))/target),
+            'indxCurr': tvc.arr_indxCurr.tolist(),
+            'intst': tvc.arr_intst.tolist()}
+
+
+def makeTVC(config):
+    """TVC configured by a replay configuration dict (keys: CONFIG_KEYS)"""
+    unknown = set(config) - set(CONFIG_KEYS) - {'name'}
+    if unknown: raise Exception("E11: unknown replay parameters: {keys}".format(keys=sorted(unknown)))
+    tvc = TVC(config.get('geometry'))
+    for key in CONFIG_KEYS[1:]:
+        if key in config: setattr(tvc, key, config[key])
+    return tvc
+
+
+def _replayJob(job):
+    """one (session, configuration) pair -- runs in a worker process"""
+    session, config, PosLine, list_block, maxIter, seed = job
+    with contextlib.redirect_stdout(io.StringIO()):
+        tvc = makeTVC(config)
+        arr_intst = session['intst']
+        if list_block:
+            list_intst, arr_prev = [], np.zeros(tvc.CONST_Ntube)
+            for block, intst_logged in zip(list_block, session['intst']):
+                valid = np.isfinite(intst_logged)   # frames which failed QC are not re-extracted
+                arr_prev = extractIntensity(tvc, [(i, path) for i, path in block if valid[i]], PosLine, arr_prev)
+                list_intst.append(np.where(valid, arr_prev, np.nan))
+            arr_intst = np.asarray(list_intst)
+        offset, slope, sigma = fitResponse(session['indxCurr'], arr_intst, tvc.DAC_LSB_default, session['exposeTube'])
+        result = simulateCAL(tvc, offset, slope, sigma, session['indxCurr'][0], maxIter, seed)
+    result.update({'directory': session['directory'], 'session': session['index'],
+                   'config': config.get('name', str(config)), 'n_iter_recorded': session['n_iter_finished'] if session['n_iter_finished'] is not None else len(session['intst']),
+                   'reExtracted': bool(list_block)})
+    return result
+
+
+def runReplay(list_directory, list_config, PosLine=150.0, reExtract=True, sortBy='name',
+              maxIter=10, seed=0, nWorkers=None):
+    """
+    replay all sessions of list_directory with every configuration of list_config
+    list_config: list of dict, e.g. {'name': 'lim2%', 'limitVariation': 0.02, 'targetRule': 'median'}
+    PosLine: line position [mm] of the recorded sessions (used for re-extraction from archive/)
+    reExtract: re-run the intensity extraction on archived frames (if they match the logged acquisitions)
+    :return: list of result dict, one per (session, configuration)
+    """
+    jobs = []
+    for directory in list_directory:
+        sessions = loadSessions(directory)
+        list_exposeTube = [expose for session in sessions for expose in session['exposeTube']]
+        for i_session, session in enumerate(sessions): session['index'] = i_session
+        for config in list_config:
+            blocks = listArchiveBlocks(makeTVC(config), directory, list_exposeTube, sortBy) if reExtract else []
+            if blocks is None:
+                print("{dir}: archived files do not match the {nI} logged acquisitions --> logged intensities are used".format(
+                    dir=directory, nI=len(list_exposeTube)))
+                blocks = []
+            i_block = 0
+            for session in sessions:
+                n = len(session['intst'])
+                jobs.append((session, config, PosLine, blocks[i_block:i_block + n], maxIter, seed))
+                i_block += n
+
+    with ProcessPoolExecutor(max_workers=nWorkers) as executor:
+        results = list(executor.map(_replayJob, jobs))
+    return results
+
+
+def writeReport(results, file_path):
+    keys = ['directory', 'session', 'config', 'n_iter_recorded', 'n_iter', 'n_shot', 'finished', 'target', 'spread', 'maxDev',
+            'reExtracted', 'indxCurr']
+    with open(file_path, 'w', newline='') as fd:
+        writer = csv.writer(fd)
+        writer.writerow(keys)
+        for result in results:
+            writer.writerow([result[key] for key in keys])
+
+
+def printReport(results):
+    print("session, config, iter(recorded), iter(replay), tube exposures, spread[%], max dev[%]")
+    for r in results:
+        print(r['session'], r['config'], r['n_iter_recorded'], r['n_iter'], r['n_shot'],
+              round(100*r['spread'], 2), round(100*r['maxDev'], 2))
+
+
+if __name__ == "__main__":
+
+    list_directory = ['D:/Data/Calibration_tube']
+    list_config = [{'name': 'default'},
+                   {'name': 'limit2%', 'limitVariation': 0.02},
+                   {'name': 'median', 'targetRule': 'median'},
+                   {'name': 'deadband2', 'DAC_deadband': 2},
+                   {'name': 'partial', 'PARTIAL': True}]
+
+    results = runReplay(list_directory, list_config, PosLine=150.0)
+    printReport(results)
+    writeReport(results, 'D:/Data/Calibration_tube/replay_report.csv')
@@ -0,0 +1,49 @@
+###########################################
+# Persistent per-file result cache (LRU, size-bounded)
+# key: (path, size, mtime, parameters) --> a changed file or changed parameters is a cache miss
+###########################################
+import os
+import json
+from collections import OrderedDict
+
+
+class ResultCache():
+    def __init__(self, file_path, maxEntries=100000):
+        self.file_path = file_path
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()        # least recently used first
+        self.n_hit, self.n_miss = 0, 0
+        self.load()
+
+    @staticmethod
+    def fileKey(path, params):
+        """params: JSON serializable parameters the result depends on (geometry, ROI, ...)"""
+        st = os.stat(path)
+        return json.dumps([os.path.abspath(path), st.st_size, st.st_mtime_ns, params], sort_keys=True)
+
+    def get(self, key):
+        if key not in self.entries:
+            self.n_miss += 1
+            return None
+        self.n_hit += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    def load(self):
+        if not os.path.exists(self.file_path): return
+        with open(self.file_path, 'r') as fd:
+            for key, value in json.load(fd):
+                self.put(key, value)
+
+    def save(self):
+        tmp = self.file_path + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(list(self.entries.items()), fd)
+        os.replace(tmp, self.file_path)
+        print("--- result cache: {n} entries, hit {h} / miss {m}".format(n=len(self.entries), h=self.n_hit, m=self.n_miss))
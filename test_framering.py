@@ -0,0 +1,142 @@
+###########################################
+# Tests of the frame ring protocol (framering.py) with the StandInProducer
+# run: python -m pytest -q test_framering.py
+###########################################
+import os
+import sys
+import subprocess
+import threading
+import pytest
+
+np = pytest.importorskip("numpy")
+from framering import FrameRing, FramePersister, StandInProducer, H_READ, H_WRITE
+
+SHAPE = (4, 6)
+
+
+@pytest.fixture
+def ring():
+    ring = FrameRing(nSlots=3, shape=SHAPE)
+    yield ring
+    ring.unlink()
+
+
+def _frame(value):
+    return np.full(SHAPE, value, dtype=np.uint16)
+
+
+def test_wrap_around(ring):
+    for i in range(10):     # > 3 x nSlots: every slot is reused
+        seq = ring.put(_frame(i), iTube=i % 7, isDummy=False, n_iter=2)
+        assert seq == i
+        got_seq, iTube, isDummy, n_iter, frame = ring.get(timeout=1)
+        assert (got_seq, iTube, isDummy, n_iter) == (i, i % 7, False, 2)
+        assert np.all(frame == i)
+        ring.release(got_seq)
+    assert ring.header[H_WRITE] == ring.header[H_READ] == 10
+
+
+def test_full_ring_blocks_producer(ring):
+    for i in range(ring.nSlots): ring.put(_frame(i), 0, False)
+    with pytest.raises(Exception, match="E21"):
+        ring.put(_frame(9), 0, False, timeout=0.05)
+    seq = ring.get(timeout=1)[0]
+    ring.release(seq)
+    assert ring.put(_frame(9), 0, False, timeout=1) == ring.nSlots
+
+
+def test_release_in_order(ring):
+    for i in range(2): ring.put(_frame(i), 0, False)
+    seq0, seq1 = ring.get(timeout=1)[0], ring.get(timeout=1)[0]
+    with pytest.raises(Exception, match="E22"):
+        ring.release(seq1)
+    ring.release(seq0)
+    ring.release(seq1)
+
+
+def test_get_timeout_and_close(ring):
+    assert ring.get(timeout=0.05) is None
+    ring.put(_frame(1), 0, False)
+    ring.close()
+    assert ring.get(timeout=1)[0] == 0     # frames committed before close() are delivered
+    assert ring.get(timeout=1) is None
+
+
+def test_consumer_attach(ring):
+    consumer = FrameRing(ring.name, create=False)
+    try:
+        assert (consumer.nSlots, consumer.shape) == (ring.nSlots, SHAPE)
+        ring.put(_frame(5), 3, True, n_iter=1)
+        seq, iTube, isDummy, n_iter, frame = consumer.get(timeout=1)
+        assert (seq, iTube, isDummy, n_iter) == (0, 3, True, 1) and np.all(frame == 5)
+        consumer.release(seq)
+        assert ring.header[H_READ] == 1
+    finally:
+        consumer.detach()
+
+
+def test_consumer_process_exit(ring):
+    """a consumer in another process attaches, reads and exits: the producer's ring must survive"""
+    ring.put(_frame(7), 2, False)
+    code = ("from framering import FrameRing\n"
+            "ring = FrameRing({name!r}, create=False)\n"
+            "print(ring.get(timeout=5)[1])\n"
+            "ring.detach()\n").format(name=ring.name)
+    result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "2"
+    assert "leaked" not in result.stderr
+    consumer = FrameRing(ring.name, create=False)     # segment still exists
+    try:
+        assert consumer.get(timeout=1)[1] == 2
+    finally:
+        consumer.detach()
+
+
+def test_concurrent_producer(ring):
+    nFrame = 50
+    producer = threading.Thread(target=lambda: [ring.put(_frame(i), 0, False, timeout=5) for i in range(nFrame)])
+    producer.start()
+    for i in range(nFrame):
+        seq, iTube, isDummy, n_iter, frame = ring.get(timeout=5)
+        assert seq == i and np.all(frame == i)
+        ring.release(seq)
+    producer.join()
+
+
+def test_persister_flush_stop(ring, tmp_path):
+    persister = FramePersister(ring)
+    nFrame = 7
+    producer = threading.Thread(target=lambda: [ring.put(_frame(i), i, False, timeout=5) for i in range(nFrame)])
+    producer.start()
+    for i in range(nFrame):
+        seq, iTube, isDummy, n_iter, frame = ring.get(timeout=5)
+        persister.persist(seq, frame, str(tmp_path / "{seq}.raw".format(seq=seq)) if i % 2 == 0 else None)
+    producer.join()
+    persister.flush()
+    assert ring.header[H_READ] == nFrame     # all slots released, in order
+    assert sorted(os.listdir(tmp_path)) == sorted("{i}.raw".format(i=i) for i in range(0, nFrame, 2))
+    for i in range(0, nFrame, 2):
+        assert np.all(np.fromfile(str(tmp_path / "{i}.raw".format(i=i)), dtype=np.uint16) == i)
+    persister.stop()
+    assert not persister.is_alive()
+
+
+def test_standin_producer(tmp_path):
+    Ndummy, list_tube = 2, [1, 4]
+    ring = FrameRing(nSlots=16, shape=SHAPE)
+    try:
+        producer = StandInProducer(ring, str(tmp_path))
+        producer.pushAcquisition([_frame(10), _frame(40)], list_tube, Ndummy, n_iter=3)
+        nFile = Ndummy + 2*len(list_tube)
+        assert producer.cnt_file == nFile and len(os.listdir(tmp_path)) == nFile
+        items = [ring.get(timeout=1) for i in range(nFile)]
+        assert [item[2] for item in items] == [True, True, False, True, False, True]
+        assert [item[1] for item in items if not item[2]] == list_tube
+        assert all(item[3] == 3 for item in items)
+        data = np.fromfile(str(tmp_path / "{n:05d}.raw".format(n=Ndummy)), dtype=np.uint16)
+        assert np.all(data == 10)
+        for item in items: ring.release(item[0])
+    finally:
+        ring.unlink()